@@ -1,23 +1,117 @@
 #!/usr/bin/env python3
 
-import sa2
-from kwp import KWPException #everything else is a class method
+from kwp import KWPException, KWPRequest, ENOENT, EINVAL, ETIME, requests #everything else is a class method
+import vwtp
+import collections
+import io
+import json
+import mmap
+import os
 import struct
+import time
+import util
+import zlib
 
+log = util.getLogger(__name__)
+
+#descriptors for the transfer loop, looked up once rather than by name on every block.
+UPLOAD = requests["requestUpload"]
+TRANSFER = requests["transferData"]
+TRANSFEREXIT = requests["requestTransferExit"]
+RMA = requests["readMemoryByAddress"]
+
+ROUTINE = KWPRequest(requests["startRoutineByLocalIdentifier"].num, "Bs") #routine number, then its arguments.
+RESULTS = requests["requestRoutineResultsByLocalIdentifier"]
+
+HEADER = 2 #transferData responses carry the response code and a block counter ahead of the data.
+RMAMAX = 0xff #readMemoryByAddress takes a one-byte size.
+RMAMIN = 0x10 #smallest chunk we'll back off to before giving up on readMemoryByAddress.
+
+PAGE = 0x1000 #FlashView fetch size.
+
+#write planning. none of these are confirmed against a real ECU; they only feed the plan and its estimate.
+ERASEBLOCK = 0x10000 #default erase block size, for ECUs with a uniform layout.
+ERASETIME = .5 #seconds to erase one block.
+RATE = 10000 #bytes/s to assume for programming, until a read on this interface has measured the link.
+CHECKSUM = "low" #which half of the CRC32 routine 0xC5 returns ("low" or "high"); the notes below aren't sure.
+CHECKPOINT = 0x10000 #dumps record progress in the sidecar file every 64k.
+RESUME = util.Retry(deadline=120, tries=8, base=1, cap=15) #recoveries per outage, before leaving the rest of the dump for a later run.
+
+def addrange(ranges, start, end): #merges [start, end) into a sorted list of disjoint [start, end) ranges.
+  out = []
+  for s, e in ranges:
+    if e < start or s > end: #disjoint and not touching.
+      out.append([s, e])
+    else:
+      start, end = min(s, start), max(e, end)
+  out.append([start, end])
+  return sorted(out)
+
+def missing(ranges, l): #the gaps in `ranges` over [0, l).
+  gaps = []
+  pos = 0
+  for s, e in ranges:
+    if s > pos:
+      gaps.append((pos, s))
+    pos = max(pos, e)
+  if pos < l:
+    gaps.append((pos, l))
+  return gaps
+
+#an image is a sparse file plus a `.ranges` sidecar recording its region and which parts of it hold real data.
+#a finished dump keeps its sidecar, marked complete; a file without one could be anything, so none of it is trusted.
+def region(path): #(base, length, finished ranges, complete) as recorded for the image at `path`, or None if there's no such image.
+  side = path + ".ranges"
+  if not os.path.exists(path) or not os.path.exists(side):
+    return None
+  with open(side) as fd:
+    state = json.loads(fd.read())
+  return state["base"], state["length"], state["done"], state.get("complete", False)
+
+def loadranges(path, base, l, partial=False): #the finished ranges of an image of [base, base + l), or none if it's missing or of another region.
+  found = region(path) #with `partial`, a complete image counts as none too: there's nothing of it to resume.
+  if not found:
+    return []
+  if found[:2] != (base, l):
+    log(3,"Existing image",path,"covers a different region, starting over")
+    return []
+  if partial and found[3]:
+    return []
+  return found[2]
+
+def transient(fault): #what a dump recovers from: the link, a timeout, or the ECU aborting the transfer. anything else will just happen again.
+  return isinstance(fault, (vwtp.VWTPException, ETIME)) or (isinstance(fault, KWPException) and str(fault) == "transferAborted")
+
+def checkpoint(side, base, l, done, complete=False): #the image data must already be on disk; this only claims it is.
+  tmp = side + ".tmp"
+  with open(tmp, "w") as fd:
+    fd.write(json.dumps({"base": base, "length": l, "done": done, "complete": complete}))
+    fd.flush()
+    os.fsync(fd.fileno())
+  os.replace(tmp, side)
 
 class FlashException(Exception):
   pass
 
 class VWECUFlashInterface:
-  def __init__(self, kwp, own=False, mode='r'):
+  def __init__(self, kwp, own=False, mode='r', method="auto"):
     self.own = own #do we own the KWP socket?
     self.kwp = kwp
     self.mode = mode
+    self.method = method #"upload" (requestUpload/transferData), "rma" (readMemoryByAddress), or "auto" for whichever moves more per request.
+    self.chunk = None #readMemoryByAddress size the ECU accepted, once we've found it.
+    self.block = 0 #transferData payload the ECU sends per block, from requestUpload.
+    self.rate = 0 #bytes/s of the last read.
     self.cursor = 0 #offset into ECU flash region
 #    self.base = 0x80000000 #FIXME: detect base flash region based on ECU
+    self.unlock()
+
+  def unlock(self): #security access for our mode; has to be redone whenever the ECU drops the session.
+    kwp = self.kwp
+    mode = self.mode
     #note: we only support 4-byte seeds, which the struct.unpack will check for us. 
     if mode == 'r':
-      seed = struct.unpack(">I", kwp.request("securityAccess", 3, b'')[2:]) #trim the response number and access level from the seed response
+      seed = struct.unpack(">I", kwp.request("securityAccess", 3, b'')[2:])[0] #trim the response number and access level from the seed response
       key = (seed + 0x00011170) & 0xffffffff #FIXME: figure out the prekey for every ECU.
     elif mode == 'w':
       ecu = kwp.request('readEcuIdentification', 92)[2:] #get hardware ID
@@ -25,8 +119,9 @@ class VWECUFlashInterface:
       for b in ecu:
         e += b
       ecu = e & 0x3f #only 3f entries in the prekey table, so clamp to that.
-      seed = struct.unpack(">I", kwp.request("securityAccess", 1, b'')[2:])
-      run = XorKey(seed, ecu)
+      seed = struct.unpack(">I", kwp.request("securityAccess", 1, b'')[2:])[0]
+      from . import sa2 #needs the third-party SA2 package, which reading doesn't.
+      run = sa2.XorKey(seed, ecu)
       key = run.run()
     try: 
       if mode == 'r':
@@ -34,40 +129,267 @@ class VWECUFlashInterface:
       elif mode == 'w':
         kwp.request("securityAccess", 2, struct.pack(">I", key))
     except KWPException as e:
-      util.log(2, "Unable to unlock ECU, probably triggered lockout.")
-      util.log(2, "if the below says 'exceedNumberOfAttempts' then go take a 10-minute drive before trying again. (to kill time; ignition only needs to be 'on' to count down)")
-      util.log(2, e)
+      log(2, "Unable to unlock ECU, probably triggered lockout.")
+      log(2, "if the below says 'exceedNumberOfAttempts' then go take a 10-minute drive before trying again. (to kill time; ignition only needs to be 'on' to count down)")
+      log(2, e)
       raise FlashException("Unable to unlock ECU?")
 
   #I think ME9.6 ECUs use PowerPC cores?
   def read(self, l): #NOTE: this does *NOT* handle an unspecified length as of now
-    if mode != 'r':
+    buf = bytearray(l)
+    n = self.readinto(buf)
+    del buf[n:] #short if the ECU aborted the transfer.
+    log(4,"Read",n,"bytes at",int(self.rate),"bytes/s")
+    return buf
+
+  def dump(self, path, l, progress=None): #streams `l` bytes from the cursor into a file, resuming an earlier dump of the same region.
+    #finished ranges are recorded in `path`.ranges as they're written; a dropped link, timeout or aborted transfer costs
+    #a re-unlock and the current 64k, not the dump. other errors stop it at once. either way, rerunning the same dump
+    #picks up where it stopped.
+    base = self.cursor
+    side = path + ".ranges"
+    done = loadranges(path, base, l, partial=True)
+    if done:
+      log(4,"Resuming dump of",path,"with",sum(b - a for a, b in done),"of",l,"bytes already read")
+    else: #the old sidecar would vouch for a file we're about to empty.
+      checkpoint(side, base, l, [])
+    if not l:
+      open(path, "wb").close()
+      checkpoint(side, base, l, [], True)
+      return 0
+    already = sum(b - a for a, b in done)
+    with open(path, "r+b" if done else "w+b") as fd:
+      fd.truncate(l) #sparse; only what's been read takes up space.
+      with mmap.mmap(fd.fileno(), l) as out:
+        start = time.perf_counter()
+        attempts = RESUME()
+        for s, e in [(s, min(s + CHECKPOINT, ge)) for gs, ge in missing(done, l) for s in range(gs, ge, CHECKPOINT)]:
+          while s < e:
+            self.cursor = base + s
+            try:
+              with memoryview(out) as mv, mv[s:e] as seg: #both released here, or the mmap can't be closed.
+                n = self.readinto(seg)
+            except (KWPException, vwtp.VWTPException, FlashException) as ex:
+              if not transient(ex):
+                log(2,"Dump failed, not retrying:",ex)
+                raise
+              n = 0
+              fault = ex
+            else: #the ECU aborted the transfer or ran dry; transient, as far as we can tell.
+              fault = FlashException("Transfer stopped short at " + hex(base + s + n))
+            if n: #checkpoint: data first, then the claim that it's there.
+              out.flush()
+              done = addrange(done, s, s + n)
+              checkpoint(side, base, l, done)
+              s += n
+              attempts = RESUME() #the link's back; the next outage gets a budget of its own, however long the dump's been running.
+              if progress:
+                read = sum(b - a for a, b in done)
+                progress(read, l, read / (time.perf_counter() - start))
+            if s < e:
+              self._recover(fault, attempts)
+        secs = time.perf_counter() - start
+    self.cursor = base + l
+    self.rate = (l - already) / secs if secs else 0
+    log(4,"Dumped",l,"bytes to",path,"at",int(self.rate),"bytes/s")
+    checkpoint(side, base, l, [[0, l]], True) #a later dump starts over; views and plans can trust all of it.
+    return l
+
+  def _recover(self, fault, attempts): #gets the channel, session and unlock back after a failed transfer, or re-raises once out of attempts.
+    pause = attempts.pause()
+    if pause is None:
+      log(2,"Giving up on dump, rerun it to resume:",fault)
+      raise fault
+    log(3,"Transfer failed, recovering in",round(pause, 1),"seconds:",fault)
+    time.sleep(pause)
+    transport = self.kwp.transport
+    try:
+      if isinstance(fault, (vwtp.VWTPException, ETIME)) and transport.reopen: #link looked up but went quiet; set the channel up again.
+        transport.reconnect()
+      if self.kwp.session is not None: #a reconnect (ours or the transport's own) leaves the ECU in its default session.
+        self.kwp.begin(*self.kwp.session)
+      self.unlock()
+    except (KWPException, vwtp.VWTPException, FlashException) as e: #the next read will fail and bring us back here.
+      log(3,"Recovery failed:",e)
+
+  def readinto(self, buf, progress=None): #fills `buf` from the cursor onwards; returns the byte count. progress(done, total, bytes/s) is called per block.
+    if self.mode != 'r':
       raise FlashException("Can't read from write-only session")
-    if l > 0xffffff:
-      raise FlashException("KWP only supports 3-byte addresses!")
-    if self.cursor > 0xffffff:
-      raise FlashException("Cursor out of range? higher than possible address space")
-    up = bytearray()
-    up += struct.pack(">I", self.cursor)[1:] #trim to 3-byte
-    up += b'00' #0: no compression, 0: no encryption (high and low nibbles, respectively)
+    with memoryview(buf) as mv: #released on the way out, so an mmap behind it can be closed even if we raise.
+      if self.cursor + len(mv) > 0x1000000:
+        raise FlashException("KWP only supports 3-byte addresses!")
+      start = time.perf_counter()
+      n = None
+      if self.method != "rma":
+        n = self._upload(mv, progress, start)
+      if n is None: #refused, or readMemoryByAddress moves more per request.
+        n = self._rma(mv, progress, start)
+    secs = time.perf_counter() - start
+    self.rate = n / secs if secs else 0
+    log(5,"Read",n,"bytes from",hex(self.cursor),"in",round(secs, 2),"seconds,",int(self.rate),"bytes/s")
+    self.cursor += n
+    return n
+
+  def _progress(self, progress, n, l, start):
+    if progress:
+      progress(n, l, n / (time.perf_counter() - start))
+
+  def _requestupload(self, l):
+    up = struct.pack(">I", self.cursor)[1:] #trim to 3-byte
+    up += b'\x00' #0: no compression, 0: no encryption (high and low nibbles, respectively)
     up += struct.pack(">I", l)[1:]
-    req = self.kwp.request("requestUpload", bytes(up))
-    size = 0
-    out = bytearray()
-    while size < l:
+    resp = self.kwp.request(UPLOAD, up)
+    return int.from_bytes(resp[1:], "big") #maxNumberOfBlockLength; the most the ECU will send per transferData.
+
+  def _upload(self, mv, progress, start): #returns None if we should use readMemoryByAddress instead.
+    l = len(mv)
+    if self.method == "auto" and self.chunk and self.chunk > self.block: #already compared on an earlier read.
+      return None
+    try:
+      blk = self._requestupload(l)
+    except KWPException as e:
+      if self.method == "upload":
+        raise
+      log(4,"requestUpload refused, falling back to readMemoryByAddress:",e)
+      self.method = "rma" #it won't change its mind this session.
+      return None
+    log(5,"ECU sends transfer blocks of up to",blk,"bytes")
+    self.block = blk - HEADER
+    if self.method == "auto" and self.chunk is None and 0 < self.block < RMAMAX: #small blocks; see if readMemoryByAddress does better.
+      self._exit()
+      if self._probe() > self.block:
+        log(4,"readMemoryByAddress moves",self.chunk,"bytes per request against",self.block,"for transferData, using that.")
+        return None
+      self.chunk = self.chunk or 0 #compared; don't probe again.
+      self._requestupload(l)
+    n = 0
+    try:
+      while n < l:
+        try:
+          buf = self.kwp.request(TRANSFER)[HEADER:] #no arguments if using it for upload from ECU.
+        except KWPException as e:
+          if str(e) == "transferAborted":
+            log(5, "Transfer Aborted by ECU")
+            break
+          raise
+        if not buf:
+          log(3,"ECU sent an empty block, stopping early!")
+          break
+        if n + len(buf) > l:
+          log(3,"ECU sent extra data, truncating!")
+          buf = buf[:l-n] #truncate extra data.
+        mv[n:n+len(buf)] = buf
+        n += len(buf)
+        self._progress(progress, n, l, start)
+    except BaseException:
       try:
-        buf = self.kwp.request("transferData", b'')[2:] #no arguments if using it for upload from ECU.
-      except KWPException as e:
-        if str(e) == "transferAborted":
-          util.log(5, "Transfer Aborted by ECU")
-          return out #current 'buf' is undefined.
-      if size + len(buf) > l:
-        util.log(3,"ECU sent extra data, truncating!")
-        buf = buf[:l-size] #truncate extra data.
-      out += buf
-      size += len(buf)
-    return out    
-    
+        self._exit()
+      except Exception as e: #likely the same fault; the original says more about it.
+        log(5,"requestTransferExit failed too:",e)
+      raise
+    self._exit()
+    return n
+
+  def _exit(self):
+    try:
+      self.kwp.request(TRANSFEREXIT)
+    except KWPException as e:
+      log(5,"requestTransferExit refused:",e)
+
+  def _readmem(self, addr, size):
+    return self.kwp.request(RMA, struct.pack(">I", addr)[1:] + bytes([size]))[1:]
+
+  def _probe(self): #bisects for the largest readMemoryByAddress the ECU accepts at the cursor; 0 if it won't do any.
+    lo, hi = 0, RMAMAX + 1 #largest accepted, smallest refused.
+    size = RMAMAX
+    while hi - lo > 1:
+      try:
+        self._readmem(self.cursor, size)
+        lo = size
+      except (ENOENT, EINVAL):
+        hi = size
+      except KWPException: #not a size problem; it won't do it at all.
+        break
+      size = (lo + hi) // 2
+    if lo < RMAMIN:
+      return 0
+    self.chunk = lo
+    return lo
+
+  def _rma(self, mv, progress, start):
+    l = len(mv)
+    if not self.chunk and not self._probe():
+      raise FlashException("ECU refuses readMemoryByAddress")
+    size = self.chunk
+    n = 0
+    while n < l:
+      want = min(size, l - n)
+      try:
+        buf = self._readmem(self.cursor + n, want)
+      except (ENOENT, EINVAL): #too big a chunk for this ECU; halve it and try again.
+        if size <= RMAMIN:
+          raise
+        size = max(size // 2, RMAMIN)
+        log(5,"readMemoryByAddress refused, trying",size,"byte chunks")
+        continue
+      if not buf:
+        log(3,"ECU returned no data, stopping early!")
+        break
+      buf = buf[:want]
+      mv[n:n+len(buf)] = buf
+      n += len(buf)
+      self._progress(progress, n, l, start)
+    self.chunk = size
+    return n
+
+  def view(self, size, base=None, **kw): #a file-like FlashView of [base, base + size); see FlashView for the options.
+    return FlashView(self, size, self.cursor if base is None else base, **kw)
+
+  def checksum(self, start, end): #routine 0xC5 (CalculateFlashChecksum) over [start, end); returns the 16-bit result.
+    arg = struct.pack(">I", start)[1:] + struct.pack(">I", end - 1)[1:] #3-byte start and (inclusive) end addresses.
+    self.kwp.request(ROUTINE, 0xC5, arg)
+    return int.from_bytes(self.kwp.request(RESULTS, 0xC5)[-2:], "big")
+
+  def plan(self, image, base=0, blocks=ERASEBLOCK, dump=None): #a WritePlan for putting `image` at `base`; nothing is written.
+    #`blocks` is an erase block size, or a list of (start, length) for ECUs with an uneven layout.
+    #each block is compared against `dump` (an image file from `dump`, partial ones included, of any region) where that covers it,
+    #otherwise against the ECU's own checksum. blocks neither can vouch for are planned for writing.
+    #the checksum is only 16 bits, of a CRC whose half (see CHECKSUM) is unverified, so a block that differs can still match
+    #and be skipped: about 1 in 65536 per changed block even if CHECKSUM is right. use a dump when that matters.
+    if isinstance(blocks, int):
+      blocks = [(base + off, min(blocks, len(image) - off)) for off in range(0, len(image), blocks)]
+    done = []
+    old = None
+    found = region(dump) if dump else None
+    if found: #the dump needn't be of the same region; only the blocks it covers are compared.
+      at, _, done, _ = found
+      old = open(dump, "rb")
+    plan = WritePlan(base, self.rate or RATE)
+    ecu = True
+    try:
+      for start, length in blocks:
+        off = start - base
+        new = image[off:off+length]
+        if old and any(a <= start - at and start - at + length <= b for a, b in done):
+          old.seek(start - at)
+          plan.add(start, length, old.read(length) != new, "dump") #both sides are local; a hash would only add work.
+          continue
+        if ecu:
+          crc = zlib.crc32(new)
+          crc = crc & 0xffff if CHECKSUM == "low" else crc >> 16
+          try:
+            plan.add(start, length, self.checksum(start, start + length) != crc, "checksum")
+            continue
+          except KWPException as e: #no checksum routine (or not in this session); don't ask for the rest either.
+            log(3,"ECU checksum unavailable, planning unverified blocks for writing:",e)
+            ecu = False
+        plan.add(start, length, True, "unverified")
+    finally:
+      if old:
+        old.close()
+    log(4,plan.summary())
+    return plan
+
   #TODO: figure out compression and encryption. rumors of encryption being RSA, evidence points to a 10-byte xor of b'RobertCode' instead.
   #Routine C5 is supposedly "CalculateFlashChecksum," which appears to return a truncated CRC32b (last two bytes? or first two?)) 
   #write routine is "requestDownload" followed by block erase (routine C4) before transfering data, exiting the transfer, then running the checksum.
@@ -75,16 +397,131 @@ class VWECUFlashInterface:
   #if you want to be clever, checksum the block and buffer before writing. because that's still *significantly* faster than an erase+program...
   #note: writes *MUST BE ALIGNED TO ERASE BLOCKS*. this command *DOES NOT CHECK THAT* because some ECUs may use wierd alignment or erase block sizes.
   def write(self, buf):
-    if mode != 'w':
+    if self.mode != 'w':
       raise FlashException("Can't write to read-only session")
-    if
     raise NotImplementedError("Writing to ECU is not yet implemented, and is *totally untested*. this will *probably* brick something. buy the maintainer an airbag controller or something to testbench with.")
 
   def seek(self, cur):
     self.cursor = cur
 
   def __enter__(self):
-    pass
+    return self
   def __exit__(self, a, b, c):
     if self.own:
       self.kwp.__exit__(a,b,c)
+
+#read-only file over ECU memory, for tools that want to open the ECU like a file (disassemblers, map finders).
+#nothing is read until it's touched; then the whole page around it is fetched and kept in an LRU cache of `cache` pages.
+#with `backing`, fetched pages also go to a sparse image file (same format and sidecar as `dump`), so later views,
+#even in later runs, only go to the ECU for pages nobody has read yet.
+class FlashView(io.RawIOBase):
+  def __init__(self, flash, size, base=0, page=PAGE, cache=64, backing=None):
+    self.flash = flash
+    self.size = size
+    self.base = base
+    self.page = page
+    self.limit = cache
+    self.pages = collections.OrderedDict() #page index -> bytes, least recently used first.
+    self.pos = 0
+    self.fetched = 0 #bytes actually read from the ECU, for the curious.
+    self.store = None
+    self.done = []
+    if backing:
+      self.side = backing + ".ranges"
+      self.done = loadranges(backing, base, size)
+      self.store = open(backing, "r+b" if os.path.exists(backing) else "w+b") #never truncate someone's image.
+      if os.path.getsize(backing) < size:
+        self.store.truncate(size)
+
+  def readable(self):
+    return True
+  def seekable(self):
+    return True
+  def tell(self):
+    return self.pos
+
+  def seek(self, off, whence=io.SEEK_SET):
+    if whence == io.SEEK_CUR:
+      off += self.pos
+    elif whence == io.SEEK_END:
+      off += self.size
+    if off < 0:
+      raise ValueError("negative seek position")
+    self.pos = off
+    return off
+
+  def readinto(self, b):
+    with memoryview(b) as mv:
+      want = max(min(len(mv), self.size - self.pos), 0)
+      n = 0
+      while n < want:
+        idx, off = divmod(self.pos + n, self.page)
+        pg = self._page(idx)
+        chunk = min(len(pg) - off, want - n)
+        mv[n:n+chunk] = pg[off:off+chunk]
+        n += chunk
+    self.pos += n
+    return n
+
+  def _page(self, idx):
+    pg = self.pages.get(idx)
+    if pg is not None:
+      self.pages.move_to_end(idx)
+      return pg
+    start = idx * self.page
+    end = min(start + self.page, self.size)
+    if self.store and any(a <= start and end <= b for a, b in self.done): #already on disk.
+      self.store.seek(start)
+      pg = self.store.read(end - start)
+    else:
+      self.flash.seek(self.base + start)
+      buf = bytearray(end - start)
+      if self.flash.readinto(buf) < len(buf):
+        raise FlashException("ECU stopped short reading page at " + hex(self.base + start))
+      pg = bytes(buf)
+      self.fetched += len(pg)
+      if self.store:
+        self.store.seek(start)
+        self.store.write(pg)
+        self.store.flush()
+        os.fsync(self.store.fileno())
+        self.done = addrange(self.done, start, end)
+        checkpoint(self.side, self.base, self.size, self.done)
+    self.pages[idx] = pg
+    if len(self.pages) > self.limit:
+      self.pages.popitem(last=False)
+    return pg
+
+  def close(self):
+    if self.store:
+      self.store.close()
+      self.store = None
+    super().close()
+
+class WritePlan: #which erase blocks a write would touch, and roughly how long it'd take. produced by VWECUFlashInterface.plan.
+  def __init__(self, base, rate):
+    self.base = base
+    self.rate = rate #bytes/s the estimate assumes.
+    self.blocks = [] #(start, length, write, how it was compared)
+
+  def add(self, start, length, write, how):
+    self.blocks.append((start, length, write, how))
+
+  @property
+  def writes(self):
+    return [b for b in self.blocks if b[2]]
+
+  def bytes(self):
+    return sum(b[1] for b in self.writes)
+
+  def estimate(self): #seconds: erase plus transfer, for the blocks that need it.
+    return len(self.writes) * ERASETIME + self.bytes() / self.rate
+
+  def summary(self):
+    return "{} of {} erase blocks to write, {} bytes, about {:.1f} seconds".format(len(self.writes), len(self.blocks), self.bytes(), self.estimate())
+
+  def report(self): #the dry run: one line per block.
+    lines = [self.summary()]
+    for start, length, write, how in self.blocks:
+      lines.append("  {:06x}-{:06x} {} ({})".format(start, start + length, "write" if write else "skip ", how))
+    return "\n".join(lines)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+import os
+import select
+import threading
+import util
+
+log = util.getLogger(__name__)
+
+#shared receive engine for the VWTP and OBD2 stacks.
+#the old per-stack threads polled `sock.recv(.05)` in a loop, which burns wakeups while idle and
+#takes up to 50ms to notice a shutdown. this blocks in select() on the CAN socket and a wakeup pipe
+#instead, so frames are handed over the moment they arrive and `stop` returns immediately.
+
+POLL = .1 #only used for buses that can't give us a file descriptor (virtual, some USB adapters)
+
+class Receiver:
+  def __init__(self, socket, handler):
+    self.socket = socket
+    self.handler = handler #called from the receive thread with every can.Message
+    self.running = False
+    self.wake = None
+    self.thread = threading.Thread(target=self._run)
+
+  def start(self):
+    self.running = True
+    self.wake = os.pipe()
+    self.thread.start()
+
+  def _fileno(self):
+    try:
+      return self.socket.fileno()
+    except (AttributeError, NotImplementedError):
+      return -1
+
+  def _run(self):
+    fd = self._fileno()
+    if fd < 0:
+      log(5,"Socket has no file descriptor, falling back to polling.")
+      return self._poll()
+    sock = self.socket
+    handler = self.handler
+    while self.running:
+      r, w, x = select.select([fd, self.wake[0]], [], [])
+      if self.wake[0] in r:
+        return
+      msg = sock.recv(0)
+      while msg: #drain everything that's already queued before going back to sleep.
+        handler(msg)
+        msg = sock.recv(0)
+
+  def _poll(self):
+    sock = self.socket
+    while self.running:
+      msg = sock.recv(POLL)
+      if msg:
+        self.handler(msg)
+
+  def stop(self):
+    if not self.running:
+      return
+    self.running = False
+    os.write(self.wake[1], b'\0')
+    if self.thread is not threading.current_thread():
+      self.thread.join()
+    os.close(self.wake[0])
+    os.close(self.wake[1])
@@ -9,14 +9,6 @@ import threading
 import queue
 import menu
 
-def recv(socket, stack):
-  while stack.open:
-    msg = socket.recv(.05)
-    if msg:
-      stack._recv(msg)
-
-
-
 def advanced():
   pass
 
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+import can
+import threading
+import time
+#a scripted VWTP gateway and KWP modules on a python-can virtual bus, for the *_test.py checks that need a live channel.
+#modules answer every request with its positive response, echoing the arguments; subclasses override `handle`.
+
+class FakeECU(threading.Thread):
+  def __init__(self, mods=(1,), channels=None, blksize=0x0F, channel="fake_ecu"):
+    super().__init__(daemon=True)
+    self.bus = can.Bus(interface="virtual", channel=channel)
+    self.channel = channel #for the tester's end of the bus.
+    self.mods = mods
+    self.channels = channels #how many channels the gateway hands out at once; None for as many as asked.
+    self.blksize = blksize
+    self.chans = {} #our RX ID -> channel state
+    self.nextid = 0x740
+    self.lock = threading.Lock() #pushes from other threads mustn't interleave their frames with a response.
+    self.running = True
+    self.peak = 0 #most channels open at once.
+    self.refused = 0
+    self.drop = 0 #ACKs to withhold, as if the block never arrived.
+    self.pings = 0
+    self.requests = 0
+
+  def stop(self):
+    self.running = False
+    self.join()
+    self.bus.shutdown()
+
+  def tester(self): #a bus for the stack under test.
+    return can.Bus(interface="virtual", channel=self.channel)
+
+  def _send(self, aid, data):
+    self.bus.send(can.Message(arbitration_id=aid, data=bytes(data), is_extended_id=False))
+
+  def run(self):
+    while self.running:
+      msg = self.bus.recv(.05)
+      if msg:
+        self._frame(msg.arbitration_id, msg.data)
+
+  def _frame(self, aid, d):
+    if aid == 0x200 and d[1] == 0xC0: #channel setup.
+      if d[0] not in self.mods:
+        return #nobody home; the tester times out.
+      rx = d[4] | (d[5] << 8)
+      if self.channels is not None and len(self.chans) >= self.channels:
+        self.refused += 1
+        self._send(0x200 + d[0], [0, 0xD6, rx & 255, rx >> 8, 0, 0, d[6]])
+        return
+      tx = self.nextid
+      self.nextid += 1
+      self.chans[tx] = {"mod": d[0], "rx": rx, "buf": bytearray(), "mark": 0, "tseq": 0}
+      self.peak = max(self.peak, len(self.chans))
+      self._send(0x200 + d[0], [0, 0xD0, rx & 255, rx >> 8, tx & 255, tx >> 8, d[6]])
+      return
+    ch = self.chans.get(aid)
+    if not ch:
+      return
+    op = d[0]
+    if op in (0xA0, 0xA3): #parameters, or a ping; both get our parameters back.
+      self.pings += op == 0xA3
+      self._send(ch["rx"], [0xA1, self.blksize, 0x8A, 0xFF, 0x00, 0xFF])
+    elif op == 0xA8: #disconnect
+      del self.chans[aid]
+      self._send(ch["rx"], [0xA8])
+    elif op & 0xC0 == 0: #data
+      ch["buf"] += d[1:]
+      if op & 0x20 == 0: #end of a block; it wants an ACK.
+        if self.drop:
+          self.drop -= 1
+          del ch["buf"][ch["mark"]:] #the tester sends the whole block again after a BRK.
+          return
+        ch["mark"] = len(ch["buf"])
+        self._send(ch["rx"], [0xB0 + ((op + 1) & 0xF)])
+      if op & 0x10: #last frame of the message: 2-byte length, then the KWP request.
+        req = bytes(ch["buf"][2:])
+        ch["buf"] = bytearray()
+        ch["mark"] = 0
+        self.requests += 1
+        resp = self.handle(ch["mod"], req)
+        if resp is not None:
+          self.push(ch["mod"], resp)
+
+  def push(self, mod, resp): #sends `resp` to the tester on `mod`'s channel, asked for or not.
+    for ch in list(self.chans.values()):
+      if ch["mod"] != mod:
+        continue
+      payload = len(resp).to_bytes(2, "big") + resp
+      frames = [payload[i:i+7] for i in range(0, len(payload), 7)]
+      with self.lock:
+        for i, f in enumerate(frames):
+          op = (0x10 if i == len(frames) - 1 else 0x20) + ch["tseq"] #the tester ACKs the last frame; nothing to wait for here.
+          ch["tseq"] = (ch["tseq"] + 1) & 0xF
+          self._send(ch["rx"], bytes([op]) + f)
+      return
+
+  def handle(self, mod, req): #the response to `req`, or None to say nothing.
+    return bytes([req[0] + 0x40]) + req[1:]
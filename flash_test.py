@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+from _vw import flash
+import vwtp
+import kwp
+import util
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from fake_ecu import FakeECU
+#checks for the range bookkeeping behind resumable dumps, then reads against a fake ECU.
+
+assert flash.addrange([], 0, 10) == [[0, 10]]
+assert flash.addrange([[0, 10]], 20, 30) == [[0, 10], [20, 30]]
+assert flash.addrange([[0, 10], [20, 30]], 10, 20) == [[0, 30]] #touching ranges merge.
+assert flash.addrange([[0, 10], [20, 30]], 5, 25) == [[0, 30]]
+assert flash.addrange([[20, 30]], 0, 5) == [[0, 5], [20, 30]] #kept sorted.
+assert flash.addrange([[0, 30]], 5, 10) == [[0, 30]]
+
+assert flash.missing([], 10) == [(0, 10)]
+assert flash.missing([[0, 10]], 10) == []
+assert flash.missing([[2, 4], [6, 8]], 10) == [(0, 2), (4, 6), (8, 10)]
+assert flash.missing([[0, 5]], 0) == []
+
+class FlashECU(FakeECU): #serves `image` over requestUpload/transferData and readMemoryByAddress, behind security access.
+  def __init__(self, image, **kw):
+    super().__init__(**kw)
+    self.image = image
+    self.unlocked = False
+    self.unlocks = 0
+    self.pos = None #transfer cursor and end, while an upload's running.
+    self.end = None
+    self.aborts = set() #addresses where a transfer is aborted once, taking the unlock with it.
+    self.dead = None #address from which every transfer is aborted.
+    self.sent = 0 #image bytes sent.
+    self.checksums = True #whether routine 0xC5 (the low half of a CRC32) is there.
+    self.range = None #what the checksum routine was last started over.
+  def handle(self, mod, req):
+    if req[0] == 0x27:
+      if req[1] == 3:
+        return b'\x67\x03\x11\x22\x33\x44'
+      assert req[2:] == (0x11223344 + 0x00011170).to_bytes(4, "big")
+      self.unlocked = True
+      self.unlocks += 1
+      return b'\x67\x04'
+    if req[0] in (0x23, 0x35, 0x36) and not self.unlocked:
+      return bytes([0x7F, req[0], 0x33])
+    if req[0] == 0x35:
+      self.pos = int.from_bytes(req[1:4], "big")
+      self.end = self.pos + int.from_bytes(req[5:8], "big")
+      return b'\x75\xff'
+    if req[0] == 0x36:
+      if self.pos in self.aborts or (self.dead is not None and self.pos >= self.dead):
+        self.aborts.discard(self.pos)
+        self.pos = None
+        self.unlocked = False
+        return b'\x7f\x36\x72'
+      data = self.image[self.pos:min(self.pos + 0xfd, self.end)]
+      self.pos += len(data)
+      self.sent += len(data)
+      return b'\x76\x01' + data
+    if req[0] == 0x37:
+      self.pos = None
+      return b'\x77'
+    if req[0] == 0x23:
+      addr = int.from_bytes(req[1:4], "big")
+      self.sent += req[4]
+      return b'\x63' + self.image[addr:addr + req[4]]
+    if req[:2] == b'\x31\xc5' and self.checksums:
+      self.range = (int.from_bytes(req[2:5], "big"), int.from_bytes(req[5:8], "big") + 1)
+      return b'\x71\xc5'
+    if req[:2] == b'\x33\xc5' and self.checksums:
+      start, end = self.range
+      return b'\x73\xc5' + (zlib.crc32(self.image[start:end]) & 0xffff).to_bytes(2, "big")
+    if req[0] in (0x31, 0x33):
+      return bytes([0x7F, req[0], 0x11])
+    return super().handle(mod, req)
+
+tmp = tempfile.mkdtemp()
+image = os.urandom(0x10000)
+flash.CHECKPOINT = 0x1000
+flash.RESUME = util.Retry(deadline=5, tries=3, base=.01)
+
+#dumps: aborted transfers cost a re-unlock and resume at the last checkpoint; a dump that gives up resumes where it stopped.
+ecu = FlashECU(image)
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  conn = stack.connect(1)
+  with kwp.KWPSession(conn) as s:
+    s.begin(0x89)
+    f = flash.VWECUFlashInterface(s, method="upload")
+    path = os.path.join(tmp, "dump.bin")
+    ecu.aborts = {0x30fd, 0x90fd}
+    assert f.dump(path, 0x10000) == 0x10000
+    assert open(path, "rb").read() == image and ecu.unlocks == 3
+    assert json.load(open(path + ".ranges")) == {"base": 0, "length": 0x10000, "done": [[0, 0x10000]], "complete": True}
+    path = os.path.join(tmp, "partial.bin")
+    ecu.dead = 0x8000
+    f.seek(0)
+    try:
+      f.dump(path, 0x10000)
+      assert False, "dump should have given up"
+    except flash.FlashException:
+      pass
+    assert json.load(open(path + ".ranges"))["done"] == [[0, 0x8000]]
+    ecu.dead = None
+    ecu.sent = 0
+    f = flash.VWECUFlashInterface(s, method="upload") #a later run; the ECU locked us out when it gave up.
+    assert f.dump(path, 0x10000) == 0x10000
+    assert open(path, "rb").read() == image and ecu.sent == 0x8000 #only the rest.
+    unlocks = ecu.unlocks
+    f.seek(0x1000000)
+    try: #an error that won't go away isn't retried.
+      f.dump(os.path.join(tmp, "high.bin"), 0x2000)
+      assert False, "addresses past 3 bytes should fail"
+    except flash.FlashException:
+      pass
+    assert ecu.unlocks == unlocks
+
+    #views: pages are fetched once and cached; with a backing file, later views only go to the ECU for what nobody's read.
+    ecu.sent = 0
+    with f.view(0x10000, base=0, cache=2) as v:
+      v.seek(0x1ff0)
+      assert v.read(0x20) == image[0x1ff0:0x2010] #across a page boundary: two pages.
+      assert v.fetched == ecu.sent == 0x2000
+      v.seek(0x1ff0)
+      assert v.read(0x20) == image[0x1ff0:0x2010] and v.fetched == 0x2000
+      v.seek(0x5000)
+      v.read(1) #evicts page 1, the least recently used.
+      v.seek(0x1000)
+      v.read(1)
+      assert v.fetched == 0x4000
+      v.seek(0xfff0)
+      assert v.read() == image[0xfff0:] #short at the end, not an error.
+    path = os.path.join(tmp, "view.bin")
+    with f.view(0x10000, base=0, backing=path) as v:
+      v.seek(0x4000)
+      assert v.read(0x2000) == image[0x4000:0x6000]
+    with f.view(0x10000, base=0, cache=1, backing=path) as v:
+      v.seek(0x4000)
+      assert v.read(0x2000) == image[0x4000:0x6000] and v.fetched == 0 #from the file, even with nothing cached.
+      v.seek(0)
+      assert v.read(0x10) == image[:0x10] and v.fetched == 0x1000
+    with f.view(0x10000, base=0, backing=os.path.join(tmp, "dump.bin")) as v: #a finished dump covers the lot.
+      assert v.read() == image and v.fetched == 0
+    path = os.path.join(tmp, "stranger.bin")
+    open(path, "wb").write(bytes(0x18000)) #no sidecar: none of it is trusted, and none of it is cut off.
+    with f.view(0x10000, base=0, backing=path) as v:
+      assert v.read(0x1000) == image[:0x1000] and v.fetched == 0x1000
+    assert os.path.getsize(path) == 0x18000
+
+    #write plans: blocks compared against a dump where it covers them, the ECU's checksum elsewhere, and written if neither can say.
+    new = bytearray(image)
+    new[0x4100] ^= 1
+    new[0xffff] ^= 1
+    p = f.plan(bytes(new), blocks=0x4000)
+    assert [(b[2], b[3]) for b in p.blocks] == [(False, "checksum"), (True, "checksum"), (False, "checksum"), (True, "checksum")]
+    assert p.bytes() == 0x8000 and p.estimate() > 0
+    path = os.path.join(tmp, "mid.bin")
+    f.seek(0x4000)
+    f.dump(path, 0x8000) #a dump of another region still covers the blocks it holds.
+    ecu.checksums = False
+    p = f.plan(bytes(new), blocks=0x4000, dump=path)
+    assert [(b[2], b[3]) for b in p.blocks] == [(True, "unverified"), (True, "dump"), (False, "dump"), (True, "unverified")]
+    assert p.report().count("\n") == 4
+  conn.close()
+bus.shutdown()
+ecu.stop()
+shutil.rmtree(tmp)
+print("OK")
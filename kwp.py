@@ -2,23 +2,38 @@ import struct
 import io
 import threading
 import queue
+from concurrent import futures
 import time
 import util
 import vwtp
 
+log = util.getLogger(__name__)
+
 #methods are stateless; used for metadata storage only.
+#a bare trailing "s" in the format is a variable-length byte string, passed through as-is (struct would truncate it to one byte).
 class KWPRequest:
   def __init__(self, num, fmt="s"):
     self.num = num
     self.fmt = fmt
+    self.resp = num + 0x40 #positive response code.
     self.b = bytes([num]) #performance improvement; only need to do this once.
+    self.tail = fmt.endswith("s") and not fmt[-2:-1].isdigit()
+    self.st = struct.Struct(fmt[:-1] if self.tail else fmt) #compiled once, rather than parsing the format on every request.
+
   def unpack(self, buf):
-    return struct.unpack(self.fmt, buf)
+    if self.tail:
+      return self.st.unpack_from(buf) + (bytes(buf[self.st.size:]),)
+    return self.st.unpack(buf)
 
   def pack(self, *val):
-    if len(val) > 0:
-      return struct.pack(self.fmt, *val)
-    return b'' #no parameters, don't call struct.pack for an empty argument.
+    if not val:
+      return b'' #no parameters, don't call struct.pack for an empty argument.
+    if self.tail:
+      tail = val[-1]
+      if isinstance(tail, int): #a single byte.
+        tail = bytes([tail])
+      return self.st.pack(*val[:-1]) + tail
+    return self.st.pack(*val)
 
 #NOTE: this is for the KWP *APPLICATION LAYER*.
 #transport and link layers are handled by kwp_phy.
@@ -70,7 +85,7 @@ requests = {
 "readMemoryByAddress": KWPRequest(0x23), #UDS Supported
 "UDSReadScalingDataByIdentifier": KWPRequest(0x24),
 "setDataRates": KWPRequest(0x26),
-"securityAccess": KWPRequest(0x27, "Bs" #UDS supported, param 0x1 is "request seed"
+"securityAccess": KWPRequest(0x27, "Bs"), #UDS supported, param 0x1 is "request seed"
 "UDSauthentication": KWPRequest(0x29), #Is UDS, or control flow "on" in DaimerChrysler KWP2000 stuff.
 "UDSReadDataByIdentifierPeriodic": KWPRequest(0x2A), 
 "DynamicallyDefineLocalIdentifier": KWPRequest(0x2C), #UDS supported
@@ -142,6 +157,24 @@ params = {
 
 }
 
+#transmission modes for periodic readDataByLocalIdentifier. the rates themselves are set with setDataRates.
+modes = {
+"single": 0x01,
+"slow": 0x02,
+"medium": 0x03,
+"fast": 0x04,
+"stop": 0x05,
+}
+
+P2 = 1 #seconds to wait for an answer, until the module's latency for the service is known.
+P2MIN = .1 #lower bound on the learned timeout; the upper bound is P2EXT.
+P2EXT = 5 #seconds to wait after a response-pending (0x78); ISO 14230's P2*max.
+RETRY = util.Retry(deadline=10, base=.05, cap=.5) #per request, from sending it to the final answer, across busy repeats and pending waits.
+
+IDLE = 1 #seconds a session's request worker waits for more work before exiting.
+
+periodicRead = KWPRequest(0x21, "BB") #readDataByLocalIdentifier with a transmission mode.
+
 
 class KWPException(Exception):
   pass
@@ -183,17 +216,17 @@ class EINVAL(KWPException):
 class EAUTH(EPERM):
   pass
 
-def timeout(sess, timeout):
-  sl = timeout/2 #play it safe, ping in half the timeout
-  while True:
-    time.sleep(sl)
-    if sess.transport._open: #implemenation detail; TODO: change that.
-      try:
-        sess.request("testerPresent")
-      except (ETIME, serviceNotSupportedException, vwtp.VWTPException): #also catch "Service Not Supported" and bail.
-        return #catch the "tried to send to closed connection" message and kill the thread cleanly.
-    else:
-      return
+#negative response codes that map to their own exception; anything else is a plain KWPException named from `responses`.
+errors = {
+0x21: (EAGAIN, "EAGAIN"), #repeat the request; either busy or "not done yet"
+0x23: (EAGAIN, "EAGAIN"),
+0x78: (EWAIT, "EWAIT"), #"Response Pending"
+0x33: (EPERM, "EPERM"), #TODO: add authentication support, and check that.
+0x31: (ENOENT, "ENOENT"),
+0x35: (EAUTH, "EAUTH"),
+0x12: (EINVAL, "EINVAL"),
+0x11: (serviceNotSupportedException, "serviceNotSupported"),
+}
 
 #no longer a global, to support higher performance from multiple KWP sessions to different parts.
 #to allow a heartbeat thread, we need to be sure
@@ -204,34 +237,70 @@ def timeout(sess, timeout):
 class KWPSession:
   def __init__(self, transport, exc=False):
     self.transport = transport
-    self.timethread = threading.Thread(target=timeout, args=(self,2))
+    self.ticker = None #testerPresent keepalive, on the transport stack's timer wheel.
+    self.timeout = 2 #session timeout; we ping at half of it.
+    self.retry = RETRY
+    self.session = None #the startDiagnosticSession parameters of the last `begin`.
     self.mfrsrv = {}
     self.mfrresp = {}
     self.exclusive = exc
     self.lock = threading.Lock() #used for callback frame management
     self.framelock = threading.Lock() #so we don't send a KWP request while we're still waiting on a response.
-    self.periodic = {}
+    self.periodic = {} #{response code: {identifier: callback}}
+    self.expect = None #(response code, identifier) of the request in flight, so its answer isn't taken for a periodic one.
+    self.dispatcher = None
+    self.dispatchq = queue.Queue()
+    self.worker = None #sends everything queued by `submit`; started on first use.
+    self.jobs = queue.Queue()
+    self.closed = False
     self.q = queue.Queue()
     self.transport.callback = lambda msg: self._recv(msg) #this is a lambda to embed a reference to self.
 
-  def registerperiodic(self, req, callback, param): #supported read types only take a single param
-    raise serviceNotSupportedException("KWP2000 periodic reads are not yet supported, poll it instead") #not yet implemented; IIRC this is UDS-only?
+  def registerperiodic(self, req, callback, param, rate="fast"): #supported read types only take a single param
+    #the callback gets every periodic response for `param`, on the session's dispatch thread.
     global requests
+    if req != "readDataByLocalIdentifier": #KWP2000 only has a transmission mode on the local identifier read.
+      raise EINVAL("Invalid Request for periodic updating")
+    if not rate in modes or rate == "stop":
+      raise EINVAL("Invalid transmission mode: {}".format(rate))
+    resp = requests[req].resp #responses are demuxed on the positive response code.
     with self.lock:
-      if req in ["readDataByLocalIdentifier", "readDataByCommonIdentifier"]:
-        if requests[req] not in self.periodic:
-          self.periodic[requests[req]] = {}
-        self.periodic[request[req]][params] = callback
-        #FIXME: make request to start periodic update
-      else:
-        raise EINVAL("Invalid Request for periodic updating")
-        
-  def deregisterperiodic(self, req, callback, param):
+      if not resp in self.periodic:
+        self.periodic[resp] = {}
+      self.periodic[resp][param] = callback
+      if not self.dispatcher:
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True) #a stream left running is no reason to hang exit.
+        self.dispatcher.start()
+    try:
+      self.request(periodicRead, param, modes[rate]) #the first response answers the request; the rest stream in.
+    except BaseException:
+      with self.lock:
+        del self.periodic[resp][param]
+      raise
+
+  def deregisterperiodic(self, req, param):
     global requests
+    resp = requests[req].resp
     with self.lock:
-      if reqeuests[req] in self.periodic:
-        if param in self.periodic[requests[req]]:
-          del self.periodic[requests[req]][param]
+      if not param in self.periodic.get(resp, {}):
+        return
+    self.request(periodicRead, param, modes["stop"]) #keep the callback until the ECU confirms, so frames still in flight go to it.
+    with self.lock:
+      del self.periodic[resp][param]
+
+  def setrates(self, *rates): #setDataRates; the layout of the slow/medium/fast rate bytes is ECU-specific.
+    return self.request("setDataRates", bytes(rates))
+
+  def _dispatch(self): #runs periodic callbacks, so a slow callback can't stall the transport's receive thread.
+    while True:
+      item = self.dispatchq.get()
+      if item is None:
+        return
+      callback, msg = item
+      try:
+        callback(msg)
+      except Exception as e:
+        log(2,"Periodic callback failed:",e)
 
   def mfr(self,service,resp):
     self.mfrsrv = service
@@ -240,85 +309,185 @@ class KWPSession:
   def begin(self, *params): #manufacturer defined; VW 0x89: "DIAG", 0x85: PROG, UDS 0x2: PROG?
     resp = self.request("startDiagnosticSession", *params)
     assert resp[0] == 0x50 #this is checked elsewhere, but make sure.
-    self.timethread.start()
+    self.session = params #so the session can be re-entered after a reconnect.
+    if not self.ticker: #begin again after a reconnect keeps the existing keepalive.
+      self.ticker = self.transport.stack.timers.add(self.timeout / 2, self._keepalive) #play it safe, ping in half the timeout
+
+  def _keepalive(self): #runs on the timer wheel; skipped while requests are flowing, since they keep the session alive.
+    if not self.transport._open: #implemenation detail; TODO: change that.
+      if not self.transport.reopen:
+        self.ticker.cancel()
+      return
+    if self.framelock.locked() or not self.jobs.empty(): #a request is in flight or queued right now.
+      return
+    self.submit("testerPresent").add_done_callback(self._keptalive) #never wait on the wheel's thread.
 
-  def request(self, req, *params):
-    if len(params) == 0:
-      util.log(5,"Performing request:",req)
-    else:
-      util.log(5,"Performing request '{}' with params: {}".format(req,params))
+  def _keptalive(self, fut):
+    if isinstance(fut.exception(), (ETIME, serviceNotSupportedException, vwtp.VWTPException)): #also catch "Service Not Supported" and bail.
+      self.ticker.cancel() #catch the "tried to send to closed connection" message and kill the timer cleanly.
+
+  def _lookup(self, req): #resolves a request name to its descriptor; shared with the asyncio session.
+    if isinstance(req, KWPRequest): #already a descriptor.
+      return req
     if not req in requests: #if we don't have a generic, try the OEM.
-      req = self.mfrsrv[req]
-      util.log(5,"Is OEM Request")
-    else:
-      req = requests[req]
+      log(5,"Is OEM Request")
+      return self.mfrsrv[req]
+    return requests[req]
+
+  def _encode(self, req, params):
+    if params:
+      return req.b + req.pack(*params)
+    return req.b
+
+  def submit(self, req, *params): #queues a request and returns a concurrent.futures.Future for its response.
+    log(5,"Submitting request:",req,*params)
+    req = self._lookup(req)
+    fut = futures.Future()
+    self.jobs.put((req, self._encode(req, params), fut))
+    with self.lock:
+      if not self.worker:
+        self.worker = threading.Thread(target=self._work)
+        self.worker.start()
+    return fut
+
+  def request(self, req, *params):
+    if threading.current_thread() is self.worker: #from a done-callback; queueing behind ourselves would deadlock.
+      req = self._lookup(req)
+      return self._transact(req, self._encode(req, params))
+    return self.submit(req, *params).result()
+
+  def request_many(self, reqs): #takes names or (name, *params) tuples; returns the responses in order, or the exception each raised.
+    futs = []
+    for req in reqs:
+      if isinstance(req, tuple):
+        futs.append(self.submit(*req))
+      else:
+        futs.append(self.submit(req))
+    results = []
+    for fut in futs:
+      try:
+        results.append(fut.result())
+      except Exception as e:
+        results.append(e)
+    return results
+
+  def _work(self): #sends queued requests one at a time; KWP over VWTP only allows one outstanding request per channel.
+    while True:
+      try:
+        job = self.jobs.get(timeout=IDLE)
+      except queue.Empty: #exit when idle, so sessions that are never closed don't keep the interpreter alive.
+        with self.lock:
+          if self.jobs.empty():
+            self.worker = None
+            return
+        continue
+      if job is None:
+        with self.lock:
+          self.worker = None
+        return
+      req, buf, fut = job
+      if not fut.set_running_or_notify_cancel(): #cancelled while queued.
+        continue
+      try:
+        fut.set_result(self._transact(req, buf))
+      except BaseException as e:
+        fut.set_exception(e)
+
+  def _p2(self, req): #how long to wait for the first answer, from how long this module has taken with this service before.
+    return self.transport.stack.latency.timeout(self.transport.mod_id, req.num, P2, P2MIN, P2EXT, borrow=False)
+
+  def _drain(self): #late answers to a timed-out request, or a stream that outran its stop request. call with the frame lock held.
+    while not self.q.empty():
+      log(5,"Dropping stale response:",self.q.get_nowait())
+
+  def _transact(self, req, buf):
+    if log.enabled(5):
+      log(5,"Performing request:",hex(req.num),buf)
+    attempts = self.retry(base=max(self.transport.packival, self.retry.base)) #never repeat faster than the ECU's own STmin.
     while True: #this is for request repetition due to "EAGAIN" response.
       try:
         with self.framelock:
-          if params:
-            p = req.pack(*params)
-            self.transport.send(req.b + p)
-          else:
-            self.transport.send(req.b)
-          while True: #since we don't demux response buffers, this is also thread-locked.
+          with self.lock:
+            self.expect = (req.resp, buf[1] if len(buf) > 1 else None)
+          self._drain()
+          wait = self._p2(req)
+          self.transport.send(buf)
+          sent = time.perf_counter()
+          while True: #one request in flight, so the next response is ours.
             try:
-              resp = self.recv(1)
-              self.check(resp, req.num + 0x40)
+              resp = self.recv(max(min(wait, attempts.left()), 0))
+              if sent: #time to the first answer, pending or not; that's what P2 bounds.
+                self.transport.stack.latency.add(self.transport.mod_id, req.num, time.perf_counter() - sent)
+                sent = None
+              self.check(resp, req.resp)
+              if self.ticker:
+                self.ticker.touch()
               return resp
             except EWAIT:
-              util.log(6,"EWAIT")
-              #recv is blocking, so just immediately keep waiting.
+              log(6,"EWAIT")
+              wait = P2EXT #the ECU has promised an answer; give it longer.
             except queue.Empty:
+              if sent: #nothing at all within P2, rather than a pending answer that never came.
+                self.transport.stack.latency.miss(self.transport.mod_id, req.num)
               raise ETIME("KWP Timeout")
-      except EAGAIN: #repeat the request after a short delay (50ms)
-        util.log(6,"EAGAIN")
-        time.sleep(self.transport.packival)
+      except EAGAIN:
+        log(6,"EAGAIN")
+        pause = attempts.pause()
+        if pause is None: #busy past the deadline; give up rather than hammer it forever.
+          raise
+        time.sleep(pause)
+
   def recv(self,timeout=None):
-    return self.q.read(timeout=timeout) #we use a callback-driven architecture for the transport, so we have our own buffering.
+    return self.q.get(timeout=timeout) #we use a callback-driven architecture for the transport, so we have our own buffering.
     #return self.transport.read(timeout) #the queue-based implementation is a blocking call if the queue is empty.
 
   def _recv(self, msg):
     with self.lock:
-      if msg[0] in self.periodic:
-        if msg[1] in self.periodic[msg[0]]:
-          self.periodic[msg[0]][msg[1]](msg)
+      if len(msg) > 1 and msg[1] in self.periodic.get(msg[0], ()):
+        if self.expect == (msg[0], msg[1]): #the answer to the request itself; any more are periodic.
+          self.expect = None
+        else:
+          self.dispatchq.put((self.periodic[msg[0]][msg[1]], msg))
           return
     self.q.put(msg)
 
   def check(self, resp, val): #format: 0x7F, [service], [code]; or [service + 0x40]
-    global responses
+    if resp[0] == val: #the common case first.
+      return True
     if resp[0] == 0x7F:
-      util.log(5,"Got Negative response:",resp)
-      if resp[2] == 0x21 or resp[2] == 0x23: #repeat the request; either busy or "not done yet"
-        raise EAGAIN("EAGAIN")
-      elif resp[2] == 0x78: #"Response Pending"
-        raise EWAIT("EWAIT")
-      elif resp[2] == 0x33:
-        raise EPERM("EPERM") #TODO: add authentication support, and check that.
-      elif resp[2] == 0x31:
-        raise ENOENT("ENOENT")
-      elif resp[2] == 0x35:
-        raise EAUTH("EAUTH")
-      elif resp[2] == 0x12:
-        raise EINVAL("EINVAL")
-      elif resp[2] == 0x11:
-        raise serviceNotSupportedException("serviceNotSupported")
+      log(5,"Got Negative response:",resp)
+      if resp[2] in errors:
+        exc, msg = errors[resp[2]]
+        raise exc(msg)
       msg = "<Unknown response {}>".format(hex(resp[2]))
       if resp[2] in responses:
         msg = responses[resp[2]] #give us the error's name.
       elif resp[2] in self.mfrresp:
         msg = self.mfrresp[resp[2]] #manufacturer-specific error
       raise KWPException(msg)
-
-    elif resp[0] == val:
-      return True
     raise ValueError("Checked frame not for us? (Not a negative response *or* the desired response!)")
 
   def close(self):
+    for resp in list(self.periodic): #stop the ECU streaming at us.
+      for param in list(self.periodic[resp]):
+        try:
+          self.deregisterperiodic("readDataByLocalIdentifier", param)
+        except (KWPException, vwtp.VWTPException):
+          pass
+    if self.dispatcher:
+      self.dispatchq.put(None)
+      self.dispatcher = None
+    with self.lock: #the worker only decides to exit under this lock, so it can't miss the sentinel.
+      worker = self.worker
+      if worker:
+        self.jobs.put(None) #anything already queued still goes out first.
+    if worker and worker is not threading.current_thread():
+      worker.join()
     if self.exclusive: #if we have an exclusive socket reference, kill it.
       self.transport.close()
-    self.timethread.join()
-    self.timethread = None #and leave a flag for the destructor.
+    if self.ticker:
+      self.ticker.cancel()
+    self.closed = True #and leave a flag for the destructor.
     
 
   def __enter__(self):
@@ -326,6 +495,6 @@ class KWPSession:
   def __exit__(self,a,b,c):
     self.close()
   def __del__(self):
-    if self.timethread:
+    if self.ticker and not self.closed:
       print("WARN: KWP object destroyed before being closed!")
       
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import util
+import kwp
+import vwtp
+from vwtp_async import LoopQueue
+
+log = util.getLogger(__name__)
+
+#asyncio flavour of the KWP session; request lookup, encoding and response checking are shared with kwp.py.
+#the testerPresent keepalive is a task on the loop, rather than a thread per session.
+
+class AsyncKWPSession(kwp.KWPSession):
+  def __init__(self, transport, exc=False):
+    super().__init__(transport, exc)
+    self.keepalive = None #a task on the loop, rather than a timer on the stack's wheel.
+    self.q = LoopQueue()
+    self.framelock = asyncio.Lock() #so we don't send a KWP request while we're still waiting on a response.
+
+  async def begin(self, *params): #manufacturer defined; VW 0x89: "DIAG", 0x85: PROG, UDS 0x2: PROG?
+    resp = await self.request("startDiagnosticSession", *params)
+    assert resp[0] == 0x50
+    self.session = params
+    if not self.keepalive:
+      self.keepalive = asyncio.ensure_future(self._timeout(self.timeout))
+
+  async def _timeout(self, timeout):
+    while self.transport._open:
+      await asyncio.sleep(timeout / 2) #play it safe, ping in half the timeout
+      try:
+        await self.request("testerPresent")
+      except (kwp.ETIME, kwp.serviceNotSupportedException, vwtp.VWTPException):
+        return
+
+  async def request(self, req, *params):
+    log(5,"Performing request:",req,*params)
+    req = self._lookup(req)
+    buf = self._encode(req, params)
+    async with self.framelock:
+      attempts = self.retry(base=max(self.transport.packival, self.retry.base))
+      while True: #this is for request repetition due to "EAGAIN" response.
+        wait = self._p2(req)
+        self._drain()
+        await self.transport.send(buf)
+        sent = time.perf_counter()
+        try:
+          while True:
+            try:
+              resp = await self.recv(max(min(wait, attempts.left()), 0))
+            except asyncio.TimeoutError:
+              if sent: #nothing at all within P2, rather than a pending answer that never came.
+                self.transport.stack.latency.miss(self.transport.mod_id, req.num)
+              raise kwp.ETIME("KWP Timeout")
+            if sent:
+              self.transport.stack.latency.add(self.transport.mod_id, req.num, time.perf_counter() - sent)
+              sent = None
+            try:
+              self.check(resp, req.resp)
+              return resp
+            except kwp.EWAIT:
+              log(6,"EWAIT")
+              wait = kwp.P2EXT
+        except kwp.EAGAIN:
+          log(6,"EAGAIN")
+          pause = attempts.pause()
+          if pause is None:
+            raise
+          await asyncio.sleep(pause)
+
+  def submit(self, req, *params): #an asyncio future rather than a thread; requests still go out one at a time under framelock.
+    return asyncio.ensure_future(self.request(req, *params))
+
+  async def request_many(self, reqs):
+    futs = [self.submit(*req) if isinstance(req, tuple) else self.submit(req) for req in reqs]
+    return await asyncio.gather(*futs, return_exceptions=True)
+
+  async def recv(self, timeout=None):
+    return await asyncio.wait_for(self.q.get(), timeout)
+
+  async def aclose(self):
+    self.closed = True
+    if self.keepalive:
+      self.keepalive.cancel()
+      self.keepalive = None
+    if self.exclusive: #if we have an exclusive socket reference, kill it.
+      await self.transport.aclose()
+
+  def registerperiodic(self, *args, **kwargs):
+    raise kwp.serviceNotSupportedException("Periodic reads are only supported on the threaded KWPSession")
+
+  def close(self):
+    raise TypeError("AsyncKWPSession must be closed with `await aclose()`")
+
+  async def __aenter__(self):
+    return self
+  async def __aexit__(self, a, b, c):
+    await self.aclose()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import kwp
+import vwtp
+import threading
+import time
+from fake_ecu import FakeECU
+#checks for request descriptor packing, then sessions against a fake ECU.
+
+req = kwp.KWPRequest(0x21, "B")
+assert req.resp == 0x61
+assert req.pack(5) == b'\x05'
+assert req.pack() == b'' #no parameters at all.
+
+req = kwp.KWPRequest(0x31, "Bs") #a bare trailing "s" passes the rest through untouched.
+assert req.pack(0xC5, b'\x01\x02\x03') == b'\xc5\x01\x02\x03'
+assert req.pack(0xC5, 7) == b'\xc5\x07' #an int there is a single byte.
+assert req.pack(0xC5, b'') == b'\xc5'
+assert req.unpack(b'\xc5\x01\x02') == (0xC5, b'\x01\x02')
+
+req = kwp.KWPRequest(0x23, "3sB") #a sized "s" is an ordinary struct field.
+assert not req.tail
+assert req.pack(b'\x01\x02\x03', 4) == b'\x01\x02\x03\x04'
+
+req = kwp.KWPRequest(0x2C) #default format is all passthrough.
+assert req.pack(b'\xf0\x04') == b'\xf0\x04'
+
+class StreamingECU(FakeECU): #streams readDataByLocalIdentifier answers for as long as a transmission mode asks it to.
+  def __init__(self, **kw):
+    super().__init__(**kw)
+    self.streams = set()
+  def handle(self, mod, req):
+    if req[0] == 0x21 and len(req) == 3:
+      if req[2] == kwp.modes["stop"]:
+        self.streams.discard(req[1])
+      elif not req[1] in self.streams:
+        self.streams.add(req[1])
+        threading.Thread(target=self._stream, args=(mod, req[1]), daemon=True).start()
+    return super().handle(mod, req)
+  def _stream(self, mod, ident):
+    n = 0
+    while True:
+      time.sleep(.01)
+      if not ident in self.streams:
+        return
+      n += 1
+      self.push(mod, bytes([0x61, ident, n & 0xff]))
+
+#periodic reads: the stream goes to its callback on the dispatch thread, and requests in between still get their own answers.
+ecu = StreamingECU()
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  conn = stack.connect(1)
+  with kwp.KWPSession(conn) as s:
+    s.begin(0x89)
+    got = []
+    s.registerperiodic("readDataByLocalIdentifier", lambda msg: got.append((bytes(msg[:2]), threading.current_thread())), 7)
+    for i in range(20):
+      assert s.request("readDataByLocalIdentifier", 1) == b'\x61\x01'
+      assert s.request("readEcuIdentification", 0x9B) == b'\x5a\x9b'
+    time.sleep(.1)
+    assert len(got) > 5
+    assert all(msg == b'\x61\x07' and thread is s.dispatcher for msg, thread in got)
+    s.deregisterperiodic("readDataByLocalIdentifier", 7)
+    assert not ecu.streams
+    time.sleep(.05) #anything still in flight when the ECU stopped.
+    n = len(got)
+    time.sleep(.1)
+    assert len(got) == n
+    assert s.request("readDataByLocalIdentifier", 7) == b'\x61\x07' #plain reads of it are ordinary requests again.
+    dispatcher = s.dispatcher
+  dispatcher.join(1) #closing the session lets the dispatch thread go.
+  assert not dispatcher.is_alive()
+  conn.close()
+bus.shutdown()
+ecu.stop()
+
+class PickyECU(FakeECU): #refuses routines, and keeps a log of what it was asked.
+  def __init__(self, **kw):
+    super().__init__(**kw)
+    self.log = []
+  def handle(self, mod, req):
+    self.log.append(req)
+    if req[0] == 0x31:
+      return b'\x7f\x31\x12'
+    return super().handle(mod, req)
+
+#submit: futures answered in order by one worker, errors in their own slot, and the worker gone once idle.
+kwp.IDLE = .1
+ecu = PickyECU()
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  conn = stack.connect(1)
+  with kwp.KWPSession(conn) as s:
+    futs = [s.submit("readDataByLocalIdentifier", i) for i in range(20)]
+    assert [f.result(timeout=5) for f in futs] == [bytes([0x61, i]) for i in range(20)]
+    assert ecu.log == [bytes([0x21, i]) for i in range(20)]
+    res = s.request_many(["testerPresent", ("startRoutineByLocalIdentifier", 0xC5), ("readEcuIdentification", 0x9B)])
+    assert res[0] == b'\x7e' and isinstance(res[1], kwp.EINVAL) and res[2] == b'\x5a\x9b'
+    chained = []
+    f = s.submit("testerPresent")
+    f.add_done_callback(lambda f: chained.append(s.request("readDataByLocalIdentifier", 1))) #runs on the worker; mustn't queue behind itself.
+    f.result(timeout=5)
+    time.sleep(.05)
+    assert chained == [b'\x61\x01']
+    time.sleep(.3)
+    assert s.worker is None
+    assert s.request("testerPresent") == b'\x7e' #and a new one starts for the next request.
+  conn.close()
+bus.shutdown()
+ecu.stop()
+print("OK")
@@ -5,6 +5,9 @@ import queue
 import threading
 import struct
 import util
+import canrx
+
+log = util.getLogger(__name__)
 
 #this doesn't build off of the existing ISOTP stack because it
 #has some special needs regarding formatting that the "standalone" stack doesn't handle.
@@ -135,12 +138,6 @@ comp_tests = {
 }
 ## END PID 1,1 test definitions
 
-def recvthread(socket, stack):
-  while stack.open:
-    msg = socket.recv(.05)
-    if msg:
-      stack._recv(msg)
-
 class OBD2Message: #state-keeping for ISO-TP
   def __init__(self, l):
     self._len = l
@@ -189,7 +186,7 @@ class OBD2DTC:
 class OBD2Interface:
   def __init__(self, socket):
     self.open = True
-    self.recvthread = threading.Thread(target=recvthread, args=(socket,self))
+    self.recvthread = canrx.Receiver(socket, self._recv)
     self.ecus = {}
     self.buffers = {
       0x7E8: queue.Queue(),
@@ -210,6 +207,8 @@ class OBD2Interface:
       0x7EE: None
     }
     self.socket = socket
+    if hasattr(socket, "set_filters"): #only wake up for ECU responses (0x7E8 -> 0x7EF), not the rest of the bus.
+      socket.set_filters([{"can_id": 0x7E8, "can_mask": 0x7F8, "extended": False}])
     self.recvthread.start()
     resp = self.readPID(1, 0) #Supported PIDs
     for k,v in resp.items():
@@ -232,13 +231,13 @@ class OBD2Interface:
   #this supports both "dumb" single-frame PID reception and one-sided ISO-TP reception (used for VIN, DTCs, and maybe some other things?)
   def _recv(self, msg):
     global DEBUG
-    util.log(6,"Recieved Frame:",msg)
+    log(6,"Recieved Frame:",msg)
     rx = msg.arbitration_id
     if rx in self.framebufs: #is an OBD-2 related frame, and not spurrious frame from elsewhere.
-      util.log(5,"Frame is one we want")
-      util.log(6,self.framebufs[rx])
+      log(5,"Frame is one we want")
+      log(6,self.framebufs[rx])
       if not (self.framebufs[rx] is None): #should be ISO-TP continuation
-        util.log(6,"Frame is multi-part component")
+        log(6,"Frame is multi-part component")
         assert 0xF0 & msg.data[0] == 0x20 #drop the sequence numbers and assert that it's a continuation frame.
         self.framebufs[rx] += msg.data[1:]
         if self.framebufs[rx].done():
@@ -247,27 +246,27 @@ class OBD2Interface:
         elif msg.data[0] & 0x0f == 0x0f:
           pass #not needed, since we explicitly tell the other end "no need to chunk this" when starting the flow.
           #flow = can.Message(arbitration_id=(rx - 8),data=[0x30,0,0,0x55,0x55,0x55,0x55,0x55],extended_id=False)
-          #util.log(5,"sending flow control frame...")
+          #log(5,"sending flow control frame...")
           #self.socket.send(flow)
       else:
         buf = msg.data
         if buf[0] & 0xf0 == 0x10: #long multi-frame message, >7 bytes.
-          util.log(5,"Frame is multi-part start")
+          log(5,"Frame is multi-part start")
           l = buf[1]
           req = buf[2] - 0x40
           pid = buf[3]
           dat = OBD2Message(l + ((buf[0] & 0xf) << 8)) #didn't cause problems before, since the VIN is less than 256 characters long...
-          util.log(6,dat)
+          log(6,dat)
           dat += buf[2:]
           self.framebufs[rx] = dat #prep to recieve more frames.
-          util.log(6,dat)
+          log(6,dat)
           #this configures flow control to be as minimal as possible:
           #unlimited block size (don't expect any ACKs), and a frame interval of 0ms (buffers be fast. and *very* deep.)
           flow = can.Message(arbitration_id=(rx - 8),data=[0x30,0,0,0x55,0x55,0x55,0x55,0x55],extended_id=False)
-          util.log(5,"sending flow control frame...")
+          log(5,"sending flow control frame...")
           self.socket.send(flow) #kick out the flow control frame to tell the ECU that.
         else: #short frame or "uncaught" frame, <8 bytes.
-          util.log(5,"Frame is short frame")
+          log(5,"Frame is short frame")
           l = buf[0]
           req = buf[1]
           pid = buf[2]
@@ -279,9 +278,9 @@ class OBD2Interface:
     self.send(ecu,dat)
     ret = {}
     for k,b in self.buffers.items():
-      util.log(5,"Checking ECU {}...".format(k))
+      log(5,"Checking ECU",k)
       resp = self._get(b)
-      util.log(5,"Checked, len:",len(resp) if resp else None)
+      log(5,"Checked, len:",len(resp) if resp else None)
       if resp:
         ret[k] = resp
     if len(ret) == 0:
@@ -290,7 +289,7 @@ class OBD2Interface:
 
   def readVIN(self):
     resp = self.readPID(9,2) #Service 9, PID 2 "Read VIN"
-    util.log(5,"Responses: ",resp)
+    log(5,"Responses: ",resp)
     resp = resp[2024] #1st ECU, usually the one with the VIN.
     assert resp[0] == 0x49, "wrong response?"
     assert resp[1] == 0x2, "not the VIN?"
@@ -314,7 +313,9 @@ class OBD2Interface:
   def close(self):
     if self.open: #to prevent lockup or errors from this being called multiple times.
       self.open = False
-      self.recvthread.join()
+      self.recvthread.stop()
+      if hasattr(self.socket, "set_filters"):
+        self.socket.set_filters(None)
 
   def __enter__(self):
     return self
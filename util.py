@@ -5,39 +5,99 @@
 import json
 import io
 import threading
-import inspect
+import sys
 import os
+import atexit
+import time
+import random
 
+class Section(dict): #a nested config section; any change marks the owning config dirty, so no manual flush() is needed.
+  def __init__(self, owner, items=()):
+    self.owner = owner
+    dict.__init__(self, {k: wrap(owner, v) for k, v in dict(items).items()})
+  def __setitem__(self, idx, item):
+    dict.__setitem__(self, idx, wrap(self.owner, item))
+    self.owner.touch()
+  def __delitem__(self, idx):
+    dict.__delitem__(self, idx)
+    self.owner.touch()
+  def setdefault(self, idx, item=None):
+    if not idx in self:
+      self[idx] = item
+    return dict.__getitem__(self, idx)
+  def update(self, *a, **kw):
+    for k, v in dict(*a, **kw).items():
+      dict.__setitem__(self, k, wrap(self.owner, v))
+    self.owner.touch()
+  def pop(self, *a):
+    ret = dict.pop(self, *a)
+    self.owner.touch()
+    return ret
+  def clear(self):
+    dict.clear(self)
+    self.owner.touch()
+
+def wrap(owner, item):
+  if isinstance(item, dict) and not isinstance(item, Section):
+    return Section(owner, item)
+  return item
+
+#writes are batched: changes mark the config dirty, and a timer writes it out `delay` seconds later
+#(and once more at exit). each write goes to a temp file that's renamed over the old one, so a crash
+#mid-write can't leave a truncated config behind.
 class Config:
-  def __init__(self, path):
-    self.lock = threading.Lock()
+  def __init__(self, path, delay=1.0):
+    self.lock = threading.Lock() #guards the dirty flag and timer
+    self.wlock = threading.Lock() #serializes writers
     self.path = None
+    self.delay = delay
+    self.dirty = False
+    self.timer = None
     if not path:
       self.backing = None
     else:
-      if not os.path.exists(path):
-        fd = open(path,"w")
-        fd.write("{}")
-        fd.close()
       self.open(path)
+      atexit.register(self.flush)
   def __getitem__(self, idx):
-    if not idx in self.backing:
-      self.backing[idx] = {}
+    if not idx in self.backing: #a read alone doesn't dirty the config; the empty section goes out with the next real change.
+      dict.__setitem__(self.backing, idx, Section(self))
     return self.backing[idx]
   def __setitem__(self, idx, item):
-    with self.lock: #ensures config writes are always consistent among threads
-      self.backing[idx] = item
-      self.flush()
+    self.backing[idx] = item
   def open(self,fname):
-    self.path = fname #no need to flush, since we do that on every config update
+    self.path = fname
+    backing = {}
+    if os.path.exists(fname):
+      try:
+        with open(fname,"r") as fd:
+          backing = json.loads(fd.read())
+      except ValueError: #should only happen to configs written before writes were atomic.
+        print("WARN: config file '{}' is corrupt, starting from defaults (old file kept as .bak)".format(fname))
+        os.replace(fname, fname + ".bak")
+    self.backing = Section(self, backing)
+  def touch(self):
     with self.lock:
-      fd = open(fname,"r")
-      self.backing = json.loads(fd.read())
-      fd.close()
-  def flush(self): #NOTE: do *NOT* add a call to 'self.lock' due to deadlocking with `__setitem__`
-    fd = open(self.path, "w")
-    fd.write(json.dumps(self.backing,indent=4))
-    fd.close()
+      self.dirty = True
+      if self.path and not self.timer:
+        self.timer = threading.Timer(self.delay, self.flush)
+        self.timer.daemon = True #the exit hook does the final flush.
+        self.timer.start()
+  def flush(self): #writes now, if anything changed.
+    with self.wlock:
+      with self.lock:
+        if self.timer:
+          self.timer.cancel()
+          self.timer = None
+        if not self.dirty:
+          return
+        self.dirty = False
+        buf = json.dumps(self.backing,indent=4)
+      tmp = self.path + ".tmp"
+      with open(tmp, "w") as fd:
+        fd.write(buf)
+        fd.flush()
+        os.fsync(fd.fileno())
+      os.replace(tmp, self.path)
 
 
 home = os.environ["HOME"]
@@ -57,15 +117,89 @@ levels = [
 "TRACE" #6
 ]
 
-def log(level, *args):
-  global config
-  modname = inspect.getmodule(inspect.stack()[1][0]).__name__ #get the calling stack frame, dereference it to the method, then get the module from it.
-  if not modname in config["log"]:
-    config["log"][modname] = 4 #initialize the module's log level config to "INFO"
-    config.flush() #need to manually flush here, since sub-module configs don't trigger our __setitem__ call.
-  if level <= config["log"][modname]:
+#per-module logger, created once at import time with `log = util.getLogger(__name__)`.
+#the level is looked up once and cached, and arguments are handed to print() as-is,
+#so a filtered-out line costs a single comparison. pass values as extra arguments rather than pre-formatting them.
+class Logger:
+  def __init__(self, modname):
+    self.name = modname
     if modname == "__main__": #don't include __main__ for module tracing.
-      print("[{}]".format(levels[level]),*args)
+      self.prefixes = ["[{}]".format(l) for l in levels]
     else:
-      print("[{}] [{}]".format(levels[level],modname),*args)
+      self.prefixes = ["[{}] [{}]".format(l, modname) for l in levels]
+    self.level = self.configured()
+
+  def configured(self):
+    global config
+    if not self.name in config["log"]:
+      config["log"][self.name] = 4 #initialize the module's log level config to "INFO"
+    return config["log"][self.name]
+
+  def enabled(self, level): #for guarding log lines whose *arguments* are expensive to compute.
+    return level <= self.level
+
+  def __call__(self, level, *args):
+    if level <= self.level:
+      print(self.prefixes[level], *args)
+
+loggers = {}
+
+def getLogger(modname):
+  if not modname in loggers:
+    loggers[modname] = Logger(modname)
+  return loggers[modname]
+
+def setLevel(modname, level): #changes (and persists) a module's level at runtime.
+  config["log"][modname] = level
+  getLogger(modname).level = level
+
+def log(level, *args): #compatibility shim for scripts; modules should hold their own logger from `getLogger`.
+  getLogger(sys._getframe(1).f_globals["__name__"])(level, *args)
+
+#retry policy shared by the KWP and VWTP layers and the module scans: an overall deadline, a try limit,
+#and exponential backoff with jitter between attempts. the policy is immutable; each retried operation takes
+#its own `Attempts` from it, so one policy can be shared by every session.
+class Retry:
+  def __init__(self, deadline=None, tries=None, base=.05, cap=1.0, factor=2.0, jitter=.5):
+    self.deadline = deadline #seconds for the whole operation, including the attempts themselves. None is unbounded.
+    self.tries = tries #None is unbounded; set at least one of these two.
+    self.base = base #first pause. ECU-facing callers scale this from the ECU's own timing.
+    self.cap = cap #longest single pause.
+    self.factor = factor
+    self.jitter = jitter #fraction of each pause that's randomized, so channels that failed together don't retry in lockstep.
+  def __call__(self, **kw): #starts a retried operation; keywords override the policy for just this one.
+    return Attempts(self, **kw)
+
+class Attempts:
+  def __init__(self, policy, **kw):
+    self.deadline = kw.get("deadline", policy.deadline)
+    self.tries = kw.get("tries", policy.tries)
+    self.delay = kw.get("base", policy.base)
+    self.cap = kw.get("cap", policy.cap)
+    self.factor = policy.factor
+    self.jitter = policy.jitter
+    self.start = time.monotonic()
+    self.n = 0 #attempts made so far.
+
+  def left(self): #seconds until the deadline.
+    if self.deadline is None:
+      return float("inf")
+    return self.start + self.deadline - time.monotonic()
+
+  def pause(self): #counts a failed attempt; returns how long to back off before the next one, or None when out of budget.
+    self.n += 1
+    if self.tries is not None and self.n >= self.tries:
+      return None
+    pause = min(self.delay, self.cap) * (1 - self.jitter * random.random())
+    self.delay *= self.factor
+    if pause >= self.left():
+      return None
+    return pause
 
+  def __iter__(self): #for the simple case: `for i in policy(): try ... break; ... else: give up`
+    while True:
+      yield self.n
+      pause = self.pause()
+      if pause is None:
+        return
+      time.sleep(pause)
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+import util
+import time
+#checks for the retry policy shared by the KWP, VWTP and scan code.
+
+r = util.Retry(tries=4, base=.01, cap=.04, jitter=0)
+a = r()
+assert [a.pause() for i in range(4)] == [.01, .02, .04, None] #doubles, capped, then out of tries.
+assert a.n == 4
+
+a = r(tries=2) #keywords override the policy for one operation, and leave the policy alone.
+assert a.pause() == .01 and a.pause() is None
+assert r.tries == 4
+
+a = util.Retry(deadline=120, base=1, cap=15, jitter=0)()
+assert a.pause() == 1
+a.start -= 130 #two minutes in, the budget's gone whatever the tries say.
+assert a.left() < 0
+assert a.pause() is None
+
+a = util.Retry(deadline=None, tries=3)() #no deadline is unbounded time.
+assert a.left() == float("inf")
+
+a = util.Retry(tries=100, base=.1, cap=.1, jitter=.5)()
+for i in range(50):
+  p = a.pause()
+  assert .05 <= p <= .1 #jitter only ever shortens a pause, by up to the given fraction.
+
+start = time.monotonic()
+assert list(util.Retry(tries=3, base=.001, jitter=0)()) == [0, 1, 2] #iterating sleeps between attempts.
+assert time.monotonic() - start >= .003
+print("OK")
@@ -6,6 +6,9 @@ import queue
 import util
 import label
 import time
+import threading
+
+log = util.getLogger(__name__)
 
 #Going off of vag-diag-sim, startRoutineByLocalIdentifier has something relating to measuring blocks with argument 0xb8.
 #it's set to return b'q\xb8\x01\x01\x01\x03\x01\x02\x01\x06\x01\x07\x01\x08\x01\r\x01\x18' when called.
@@ -57,7 +60,7 @@ class blockMeasure:
     ret = blockMeasure(self.name, None)
     try:
       ret.value = self.func(a,b)
-    except DivideByZeroError:
+    except ZeroDivisionError:
       ret.value = None #scaler fucked up, but we don't want to crash...
     return ret
   def __str__(self):
@@ -101,34 +104,72 @@ scalers = {
 }
 
 
-def parseBlock(block, mod=None): #takes a raw KWP response.
+def parseBlock(block, mod=None, limit=4): #takes a raw KWP response.
+  #measuring blocks are *up to* 4 fields long; dynamically defined ones (see DynamicBlock) can hold more, so pass limit=None.
   blk = []
   buf = block[2:] #drop the KWP op and param
   idx = 0
   try:
-   for i in range(4):
-    if buf[idx] in scalers:
-      if scalers[buf[idx]].size <=3:
-        blk.append(scalers[buf[idx]].unscale(buf[idx+1], buf[idx+2]))
+    while idx < len(buf) and (limit is None or len(blk) < limit):
+      scaler = scalers.get(buf[idx], scalers[0x100])
+      if scaler.size <= 3:
+        blk.append(scaler.unscale(buf[idx+1], buf[idx+2]))
         idx += 3
-      else:
-        #print(repr(buf))
-        var = scalers[buf[idx]].unscale(buf[idx+1:], None)
-        #print(var)
-        blk.append(var)
-        idx += len(blk[-1].value)
-    else:
-      blk.append(scalers[256].unscale(buf[i+1], buf[i+2]))
+      else: #variable length, A is the rest of the buffer; skip the formula and length bytes too.
+        blk.append(scaler.unscale(buf[idx+1:], None))
+        idx += len(blk[-1].value) + 2
   except IndexError:
-    pass #stomp on indexerrors, measuring blocks can be *up to* 4 fields long; some are "8" (need a firmware dump to investigate that...)
+    pass #stomp on indexerrors, some blocks are "8" (need a firmware dump to investigate that...)
   if mod: #don't look up block labels if we just want a basic parse.
     try:
-      for i in range(4):
+      for i in range(len(blk)):
         blk[i].label = labels[mod.pn][i]
     except KeyError:
       pass
   return blk
 
+#DynamicallyDefineLocalIdentifier (0x2C) definition modes, as per ISO 14230-3.
+DEFINEBYLOCALID = 0x01
+CLEARDYNAMICID = 0x04
+
+class DynamicBlock: #packs fields from several measuring blocks into one identifier, so a logging cycle is a single request.
+  def __init__(self, mod, fields, ident=0xF0):
+    self.mod = mod
+    self.fields = list(fields) #[(block, field index)], in the order `read` returns them.
+    self.ident = ident #dynamically defined identifiers live at 0xF0->0xF9.
+    self.defined = False
+
+  def define(self): #returns whether the ECU took it; if not, `read` falls back to reading each block.
+    body = bytearray([self.ident])
+    for pos, (blk, field) in enumerate(self.fields):
+      #definition mode, position in our identifier, size, source block, position in the source block (1-based).
+      #each field copies its formula byte too, so the result decodes like a measuring block.
+      body += bytes([DEFINEBYLOCALID, 1 + pos * 3, 3, blk, 1 + field * 3])
+    try:
+      self.clear()
+    except kwp.KWPException as e: #plenty of ECUs refuse to clear an identifier that was never defined.
+      log(5,"ECU didn't clear dynamic identifier",hex(self.ident),e)
+    try:
+      self.mod.kwp.request("DynamicallyDefineLocalIdentifier", bytes(body))
+      self.defined = True
+    except kwp.KWPException as e:
+      log(4,"ECU refused dynamic identifier",hex(self.ident),"falling back to per-block reads:",e)
+      self.defined = False
+    return self.defined
+
+  def clear(self):
+    self.defined = False
+    self.mod.kwp.request("DynamicallyDefineLocalIdentifier", bytes([self.ident, CLEARDYNAMICID]))
+
+  def read(self): #returns a list of blockMeasure, one per field.
+    if self.defined:
+      return parseBlock(self.mod.kwp.request("readDataByLocalIdentifier", self.ident), limit=None)
+    blocks = {}
+    for blk, field in self.fields: #one read per distinct block, rather than per field.
+      if not blk in blocks:
+        blocks[blk] = parseBlock(self.mod.readBlock(blk))
+    return [blocks[blk][field] for blk, field in self.fields]
+
 def labelBlock(ecu, blknum, blk):
   for i in range(len(blk)):
     blk.label = labels[(ecu,blknum)][i]
@@ -197,8 +238,83 @@ modules = {
 #0x77: "CarPhone", #yes, some cars do have a built in cellular phone, and yes, they were made post-smartphone.
 }
 
+#how long a response stays cached, in seconds; keyed by (service, param) first, then by service.
+#identification data can't change while the ignition is on, so an hour is conservative. anything not listed isn't cached.
+cachettl = {
+"readEcuIdentification": 3600,
+("readDataByLocalIdentifier", 80): 3600, #manufacture info
+("readDataByLocalIdentifier", 81): 3600, #ID block
+("readDataByLocalIdentifier", 82): 3600, #firmware version
+}
+
+#the gateway's installation list, ie: which modules it's coded to expect. where it lives (and its layout) is unverified
+#and may well vary between gateways, so it can be overridden with an "installlist" entry in the config's "vw" section.
+#"list" is one address byte per installed module, "bitmap" is one bit per address, LSB first.
+installlist = {"module": 0x1f, "service": "readDataByLocalIdentifier", "param": 0x9F, "format": "list"}
+try:
+  installlist.update(util.config["vw"]["installlist"])
+except KeyError:
+  pass
+
+def parseInstalled(buf, fmt): #buf starts after the KWP op and param.
+  if fmt == "bitmap":
+    return [i for i in range(1, len(buf) * 8) if buf[i // 8] >> (i % 8) & 1]
+  return sorted(set(b for b in buf if b)) #unused slots are zeroes.
+
+#connect attempts per module when scanning. a missing module costs its connect timeouts plus these pauses,
+#so the deadline keeps one absent module from holding up the whole scan.
+SCANRETRY = util.Retry(deadline=2, tries=3, base=.2, cap=1)
+
+class ResponseCache: #caches KWP responses per (module, service, param), shared by every module of a vehicle.
+  def __init__(self, ttls=None):
+    self.ttls = dict(cachettl) if ttls is None else ttls
+    self.entries = {} #{(mod, service, param): (expiry, response or exception)}
+    self.lock = threading.Lock() #`each` reads modules from several threads at once.
+
+  def ttl(self, service, param):
+    return self.ttls.get((service, param), self.ttls.get(service, 0))
+
+  def peek(self, mod, service, param): #the live cached response or exception, or None; doesn't touch the ECU.
+    with self.lock:
+      ent = self.entries.get((mod, service, param))
+    if ent is not None and ent[0] > time.monotonic():
+      return ent[1]
+    return None
+
+  def has(self, mod, service, param): #only successful responses count; a cached refusal still needs the fallback request.
+    ent = self.peek(mod, service, param)
+    return ent is not None and not isinstance(ent, kwp.KWPException)
+
+  def request(self, session, mod, service, param):
+    key = (mod, service, param)
+    with self.lock:
+      ent = self.entries.get(key)
+    if ent and ent[0] > time.monotonic():
+      log(6,"Cached response for",key)
+      if isinstance(ent[1], kwp.KWPException):
+        raise ent[1]
+      return ent[1]
+    ttl = self.ttl(service, param)
+    try:
+      resp = session.request(service, param)
+    except (kwp.serviceNotSupportedException, kwp.ENOENT, kwp.EINVAL) as e: #the ECU won't change its mind about these either.
+      if ttl:
+        with self.lock:
+          self.entries[key] = (time.monotonic() + ttl, e)
+      raise
+    if ttl:
+      with self.lock:
+        self.entries[key] = (time.monotonic() + ttl, resp)
+    return resp
+
+  def invalidate(self, mod=None, service=None, param=None): #None matches anything; no arguments clears the whole cache.
+    with self.lock:
+      for key in list(self.entries):
+        if (mod is None or key[0] == mod) and (service is None or key[1] == service) and (param is None or key[2] == param):
+          del self.entries[key]
+
 class VWModule:
-  def __init__(self, kwp, mod, exc=False):
+  def __init__(self, kwp, mod, exc=False, cache=None):
     self.idx = mod
     if mod in modules:
       self.name = modules[mod]
@@ -207,8 +323,14 @@ class VWModule:
     self.pn = None
     self._name = None
     self.kwp = kwp
+    self.cache = cache #a ResponseCache, usually the vehicle's.
     self.exclusive=exc #is our KWP session exclusive to us?
 
+  def _request(self, service, param): #for reads that may be served from the cache.
+    if self.cache:
+      return self.cache.request(self.kwp, self.idx, service, param)
+    return self.kwp.request(service, param)
+
   def __str__(self):
     if not self.pn:
       self.readPN()
@@ -218,8 +340,8 @@ class VWModule:
     self.pn = True
     ret = {}
     blk = self.readBlock(81)
-    util.log(4,"ID structure parsing not implemented yet; raw message:",blk)
-    util.log(4,"ParseBlock output:",parseBlock(blk))
+    log(4,"ID structure parsing not implemented yet; raw message:",blk)
+    log(4,"ParseBlock output:",parseBlock(blk))
     return NotImplemented
 
   def readPN(self):
@@ -227,13 +349,13 @@ class VWModule:
     #VW uses the latter two for that as well. but on VWs, 0x86 is manufacture info, and 0x87 is firmware version (I think?)
     #We first try to retrieve the full identification
     try:
-      util.log(6,"Reading ECU identification...")
-      req = self.kwp.request("readEcuIdentification", 0x9B) #Read Part Identification
+      log(6,"Reading ECU identification...")
+      req = self._request("readEcuIdentification", 0x9B) #Read Part Identification
       pn = req[2:14]
       self._name = req[0x1c:].decode("ascii").rstrip()
     except kwp.KWPException:
-      util.log(5,"Fault retrieving full ID block, falling back to plain part number!")
-      req = self.kwp.request("readEcuIdentification", 0x91) #Read raw VAG number (ECU ID)
+      log(5,"Fault retrieving full ID block, falling back to plain part number!")
+      req = self._request("readEcuIdentification", 0x91) #Read raw VAG number (ECU ID)
       l = req[2]
       pn = req[3:2+l] #length byte includes itself...
       self._name = "<Unknown, could not retreive name>"
@@ -248,24 +370,25 @@ class VWModule:
       buf += b'-'
       buf += pn[9:]
     self.pn = bytes(buf).decode("ascii").strip() #full ID block's PN has trailing spaces, so drop those.
+    if self.kwp: #no session when it was answered from the cache without connecting.
+      self.kwp.transport.learn(self.pn) #transport parameters are tuned per part number.
 
   def readManufactureInfo(self):
     ret = {}
     blk = self.readBlock(80)
-    util.log(4,"Manufacture info structure parsing not implemented yet; raw message:",blk)
+    log(4,"Manufacture info structure parsing not implemented yet; raw message:",blk)
     return NotImplemented
 
   def readFWVersion(self):
     ret = {}
     blk = self.readBlock(82)
-    util.log(4,"FW version structure parsing not implemented yet; raw message:",blk)
+    log(4,"FW version structure parsing not implemented yet; raw message:",blk)
     return NotImplemented
 
   def readFW(self):
     import _vw.flash as flash
-    with flash.VWECUFlashInterface(self.kwp, 'r') as flsh:
-      with open('fw.bin', 'wb') as ofd:
-        ofd.write(flsh.read(0x200000)) #2MB.
+    with flash.VWECUFlashInterface(self.kwp, mode='r') as flsh:
+      flsh.dump('fw.bin', 0x200000) #2MB.
 
   def getDTC(self): #note: this returns a *different format* to the one below.
     dtcs = {}
@@ -280,7 +403,7 @@ class VWModule:
             dtc = req[ii+2:ii+4]
             dtcs[i].append(dtc)
       except kwp.EPERM:
-        util.log(3,"Got permission denied reading DTC group '{}'?".format(hex(i)))
+        log(3,"Got permission denied reading DTC group",hex(i))
       except kwp.KWPException:
         pass #just means invalid group or something
     return dtcs
@@ -311,7 +434,12 @@ class VWModule:
       self.readPN()
     return parseBlock(self.readBlock(blk), self)
   def readBlock(self, blk):
-    return self.kwp.request("readDataByLocalIdentifier", blk)
+    return self._request("readDataByLocalIdentifier", blk)
+
+  def defineBlock(self, fields, ident=0xF0): #fields is [(block, field index)]; see DynamicBlock.
+    blk = DynamicBlock(self, fields, ident)
+    blk.define()
+    return blk
   
   def readLongCode(self,code):
     raise NotImplementedError("Need VCDS Trace to figure out KWP commands")
@@ -346,42 +474,100 @@ class VWModule:
 class VWVehicle:
   def __init__(self, stack):
     self.stack = stack;
+    self.scheduler = vwtp.VWTPScheduler(stack)
+    self.cache = ResponseCache() #identification reads; lives as long as the vehicle object, ie: one ignition cycle.
     self.enabled = []
     self.parts = {}
     self.scanned = False
 
   #note: everything that calls this *must* check if already scanned.
   #this doesn't, to allow for manual rescan.
-  def enum(self): #a crude enumeration primitive of all *known* ECUs
+  def enum(self, progress=None, gateway=False): #enumerates all *known* ECUs, probing as many at once as the scheduler has channels.
+    #`progress(mod, part number or exception, done, total)` is called as each module is settled; modules that answer
+    #are reported from the scan threads as they come in, missing ones once the retries run out.
+    #with `gateway`, only the modules on the gateway's installation list are probed (falling back to all of them if it can't be read).
     global modules
     self.scanned = True
-    util.log(5,"Enumerating Modules...")
-    for mod in modules.keys():
-      for i in range(3): #try 3 times for each module
-        try:
-          util.log(5,"Trying Module '{}', Try {}".format(modules[mod], i))
-          m = self.module(mod)
-          m.readPN()
-          util.log(5,"Found module:",modules[mod],"Part Number:",m.pn)
-          m.close()
-          self.enabled.append(mod)
-          self.parts[mod] = modules[mod] + " -> " + m.pn
-          break
-        except (vwtp.ETIME) as e:
-          if i == 3: #if it's the last go-round, *then* we log it as "not found"
-            util.log(5,"Module not found:",repr(e)) #squash the exception; just means "module not detected"
-        except (kwp.KWPException) as e: #we connected, but something fucked up.
-          util.log(3,"Communication Fault reading from module, but assuming it's present:",modules[mod])
-          util.log(3,"Exception:",e)
-          self.enabled.append(mod)
-          break
-        time.sleep(.2)
+    log(5,"Enumerating Modules...")
+    targets = modules
+    installed = self.installed() if gateway else None
+    if installed is not None:
+      targets = {mod: modules.get(mod, "Unknown module {:02x}".format(mod)) for mod in installed}
+    lock = threading.Lock()
+    found = {}
+    state = {"done": 0}
+    def settle(mod, res):
+      with lock: #the callback's under the lock too, so it doesn't need its own.
+        found[mod] = res
+        state["done"] += 1
+        if progress:
+          progress(mod, res, state["done"], len(targets))
+    pending = []
+    for mod in targets.keys():
+      #readPN can only be answered from the cache if 0x9B's answer is cached, or its refusal is and 0x91's answer is.
+      refused = isinstance(self.cache.peek(mod, "readEcuIdentification", 0x9B), kwp.KWPException)
+      if self.cache.has(mod, "readEcuIdentification", 0x9B) or (refused and self.cache.has(mod, "readEcuIdentification", 0x91)):
+        m = VWModule(None, mod, cache=self.cache) #already identified; no need to connect.
+        m.readPN()
+        settle(mod, m.pn)
+      else:
+        pending.append(mod)
+    def probe(m):
+      m.readPN()
+      return m.pn
+    def answered(mod, res):
+      if isinstance(res, str):
+        log(5,"Found module:",targets[mod],"Part Number:",res)
+        settle(mod, res)
+      elif isinstance(res, kwp.KWPException): #we connected, but something fucked up.
+        log(3,"Communication Fault reading from module, but assuming it's present:",targets[mod])
+        log(3,"Exception:",res)
+        settle(mod, res)
+    attempts = SCANRETRY(deadline=None) #rounds, not modules, take the tries; every round retries all the stragglers together.
+    while pending:
+      log(5,"Trying",len(pending),"modules, try",attempts.n)
+      results = self.each(pending, probe, answered)
+      pending = [mod for mod in pending if not mod in found]
+      for mod in pending:
+        if not isinstance(results[mod], (vwtp.ETIME, vwtp.ERefused)):
+          log(3,"Unexpected fault probing module",targets[mod],repr(results[mod]))
+      pause = attempts.pause() if pending else None
+      if pause is None:
+        break
+      time.sleep(pause)
+    for mod in pending: #out of tries, *then* we log it as "not found"
+      log(5,"Module not found:",targets[mod],repr(results[mod])) #squash the exception; just means "module not detected"
+      settle(mod, results[mod])
+    self.enabled = [mod for mod in targets if isinstance(found.get(mod), (str, kwp.KWPException))]
+    self.parts = {mod: targets[mod] + " -> " + found[mod] if isinstance(found[mod], str) else targets[mod] for mod in self.enabled}
+
+  def each(self, mods, func, done=None): #calls func(VWModule) on several modules at once, returns {mod: result or exception}
+    #`done(mod, result or exception)` is called from the scan threads as each one finishes.
+    def run(mod, conn):
+      k = kwp.KWPSession(conn, exc=True)
+      k.begin(0x89)
+      with VWModule(k, mod, True, self.cache) as m:
+        return func(m)
+    return self.scheduler.run(mods, run, done)
+
+  def installed(self): #the addresses the gateway's coded to expect (itself included), or None if it won't say.
+    try:
+      with self.module(installlist["module"]) as gw:
+        buf = gw._request(installlist["service"], installlist["param"])
+    except (kwp.KWPException, vwtp.VWTPException, ValueError) as e:
+      log(3,"Couldn't read the gateway installation list, probing instead:",repr(e))
+      return None
+    mods = parseInstalled(buf[2:], installlist["format"])
+    if not installlist["module"] in mods:
+      mods.append(installlist["module"]) #we just talked to it, so it's there.
+    log(5,"Gateway lists modules:",[hex(m) for m in mods])
+    return mods
 
   def module(self, mod):
     #note: the "exc" flag in the KWP session means "exclusively owned transport socket, close it when you're closed"
     k = kwp.KWPSession(self.stack.connect(mod),exc=True)
     k.begin(0x89) #0x89 is diag, 0x85 is PROG.
-    return VWModule(k, mod)
+    return VWModule(k, mod, True, self.cache) #ours alone, so closing the module closes the channel.
 
   def __enter__(self):
     return self
@@ -419,30 +605,30 @@ def brutemap(stack, ecu, req, r):
      except kwp.EPERM:
       blks["locked"].append(hex(i))
      except (ValueError, kwp.ETIME, kwp.KWPException) as e:
-      util.log(4,e)
+      log(4,e)
       if type(e) == kwp.serviceNotSupportedException: #if the service isn't supported, don't bother mapping it. because it won't work.
         return "serviceNotSupported" #because we just punt the output into JSON, this works fine.
      time.sleep(.1)
     return blks
 
-def modmap(car):
+def modmap(car, gateway=False): #with `gateway`, only maps the modules on the gateway's installation list, if it has one.
   mods = {}
-  for i in range(1,256):
-    for ii in range(3):
+  addrs = car.installed() if gateway else None
+  for i in addrs or range(1,256):
+    for ii in SCANRETRY(base=.5): #give the gateway time to reset between timeouts
       try:
         mod = car.module(i)
         with mod:
           m = str(mod)
           a = hex(i)[2:]
-          util.log(5,"Found module '{}' at address '{}'".format(m, a))
+          log(5,"Found module",m,"at address",a)
           mods[a] = m #get the part number and name.
           break #break the retry loop.
       except kwp.KWPException as e: #fault reading part number; means module is there but fucked up.
-        util.log(3,"Module Read Error: {}: {}".format(hex(i)[2:],e))
+        log(3,"Module Read Error:",hex(i)[2:],e)
         break
-      except (ValueError, queue.Empty): #fault connecting to module
-        util.log(5,"Module connect timeout:",hex(i)[2:])
-      time.sleep(.5) #give the gateway time to reset between timeouts
+      except (ValueError, queue.Empty, vwtp.ETIME, vwtp.ERefused): #fault connecting to module
+        log(5,"Module connect timeout:",hex(i)[2:])
   return mods
 
 if __name__ == "__main__":
@@ -457,13 +643,13 @@ if __name__ == "__main__":
     for k in car.enabled:
       print(" ",modules[k])
 
-    util.log(4,"Enumerating Identifiers for all Modules...")
+    log(4,"Enumerating Identifiers for all Modules...")
     mods = modmap(car)
     with open("mods.json", "w") as fd:
       fd.write(json.dumps(mods,indent=4)) #is all primitives, so jsonpickle is not needed here.
 
     for mod in car.enabled:
-      utl.log(4, "Probing Module Identifiers for '{}'".format(modules[mod]))
+      log(4, "Probing Module Identifiers for", modules[mod])
       m = { "readDataByLocalIdentifier": range(1,256), "readEcuIdentification": range(1,256), "readDataByCommonIdentifier": range(1,65535) }
       fault = None
       try:
@@ -474,7 +660,7 @@ if __name__ == "__main__":
       if not fault:
         with car.module(mod) as m: #TODO: add a "risky" mode that enumerates OEM-specific services (which may potentially set off airbags and such)
           srv = {}
-          util.log(4, "Supported Services...")
+          log(4, "Supported Services...")
           for s, n in kwp.services.items():
             if s <= 0x11: #OBD-2, StartSession, and EcuReset. we don't want to poke those.
               continue
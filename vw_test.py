@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+import vw
+import vwtp
+import kwp
+from fake_ecu import FakeECU
+#checks for the response decoders that don't need an ECU, then the identification cache against a fake one.
+
+assert vw.parseInstalled(b'\x01\x03\x17\x00\x00', "list") == [0x01, 0x03, 0x17] #unused slots are zeroes.
+assert vw.parseInstalled(b'\x17\x01\x17', "list") == [0x01, 0x17] #sorted, no repeats.
+assert vw.parseInstalled(b'', "list") == []
+assert vw.parseInstalled(bytes([0b1010, 0, 0x80]), "bitmap") == [0x01, 0x03, 0x17] #bit n is address n, LSB first.
+assert vw.parseInstalled(b'\x01', "bitmap") == [] #bit 0 would be address 0, which isn't a module.
+
+blk = vw.parseBlock(b'\x61\x02' + bytes([0x01, 2, 10, 0x15, 2, 100, 0x5F, 3]) + b'abc' + bytes([0x01, 1, 1, 0x01, 2, 2]))
+assert [b.value for b in blk[:3]] == [4.0, 0.2, "abc"] #the string's length byte is skipped too.
+assert len(blk) == 4 #measuring blocks stop at 4 fields...
+assert len(vw.parseBlock(b'\x61\xf0' + bytes([0x01, 1, 1]) * 6, limit=None)) == 6 #...dynamic ones don't.
+assert len(vw.parseBlock(b'\x61\x02' + bytes([0x99, 1, 2, 0x01, 2, 10]))) == 2 #unknown formulas still advance.
+
+class IdentECU(FakeECU): #module 1 has the full identification; module 3 only the plain part number.
+  def handle(self, mod, req):
+    if req == b'\x1a\x9b':
+      if mod == 3:
+        return b'\x7f\x1a\x12'
+      return b'\x5a\x9b' + b'1K0907379AC ' + bytes(14) + b'ABS MK60  '
+    if req == b'\x1a\x91':
+      return b'\x5a\x91\x0c' + b'1K0907379AC'
+    return super().handle(mod, req)
+
+#cache: a second scan and repeated ID block reads don't go to the ECU; invalidating a module sends only it back there.
+vw.modules = {1: "Engine", 3: "ABS"}
+ecu = IdentECU(mods=(1, 3))
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  car = vw.VWVehicle(stack)
+  car.enum()
+  assert car.parts == {1: "Engine -> 1K0-907-379-AC", 3: "ABS -> 1K0-907-379-AC"}
+  channels, asked = ecu.nextid, ecu.requests
+  car.enum()
+  assert car.parts[3] == "ABS -> 1K0-907-379-AC" #from the cached refusal of 0x9B and the cached 0x91.
+  assert (ecu.nextid, ecu.requests) == (channels, asked) #not even a channel.
+  assert isinstance(car.cache.peek(3, "readEcuIdentification", 0x9B), kwp.EINVAL)
+  assert not car.cache.has(3, "readEcuIdentification", 0x9B) #a refusal only says to ask for 0x91 instead.
+  with car.module(1) as m:
+    asked = ecu.requests
+    assert m.readBlock(81) == m.readBlock(81) == b'\x61\x51'
+    assert ecu.requests == asked + 1
+    m.readBlock(5)
+    m.readBlock(5) #live data isn't cached.
+    assert ecu.requests == asked + 3
+  car.cache.invalidate(mod=1)
+  assert not car.cache.has(1, "readEcuIdentification", 0x9B) and car.cache.has(3, "readEcuIdentification", 0x91)
+  channels = ecu.nextid
+  car.enum()
+  assert ecu.nextid == channels + 1 and len(car.enabled) == 2
+bus.shutdown()
+ecu.stop()
+print("OK")
@@ -1,9 +1,15 @@
 import queue
 import can
+import json
 import struct
 import time
 import threading
+import os
 import util
+import canrx
+
+log = util.getLogger(__name__)
+
 #Volkswagen Transport Protocol
 
 #FIXME: 
@@ -21,25 +27,83 @@ if DEBUG:
   time.sleep = sleep #crude debug hook for debugging timeouts
 
 
-_threadrun = True
-#VWTP was architectured for an asynchronous socket, but python sockets are synchronous,
-#so we need a thread to do that for us.
-def recvthread(stack):
-  sock = stack.socket
-  while stack.open:
-    msg = sock.recv(.05)
-    if msg:
-      stack._recv(msg)
-
-def pingthread(conn):
-  try:
-    while conn._open or conn.reopen: #keep the thread spinning while reconnecting
-      time.sleep(.5)
-      if conn._open:
-        util.log(6,"Ping!")
-        conn._send([0xa3]) #but don't actually *send* anything.
-  except VWTPException: #just die cleanly.
-    pass
+
+CHANNELS = 16 #RX IDs 0x300 -> 0x30F; the gateway may well allow fewer.
+
+class Ticker: #a periodic keepalive on a TimerWheel.
+  def __init__(self, interval, func):
+    self.interval = interval
+    self.func = func
+    self.due = 0
+    self.dead = False
+
+  def touch(self): #real traffic went out, so push the keepalive back a full interval.
+    self.due = time.monotonic() + self.interval
+
+  def cancel(self):
+    self.dead = True
+
+#one thread fires every keepalive on a stack (VWTP pings and KWP testerPresent) instead of a sleeping thread each.
+#new timers start in the least-loaded slot of their first interval, so pings from many channels don't all burst at once.
+#callbacks run on the wheel's thread; they must be short, and must not wait on another timer.
+class TimerWheel:
+  def __init__(self, tick=.05, slots=64):
+    self.tick = tick
+    self.slots = [[] for i in range(slots)]
+    self.cursor = 0
+    self.base = 0 #monotonic time of the slot under the cursor
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def add(self, interval, func):
+    t = Ticker(interval, func)
+    n = len(self.slots)
+    with self.lock:
+      if not self.thread: #started lazily, so stacks that never open a channel never get a thread.
+        self.base = time.monotonic()
+        self.thread = threading.Thread(target=self._run, daemon=True) #keepalives are no reason to outlive the program.
+        self.thread.start()
+      span = max(1, min(n - 1, int(interval / self.tick)))
+      ahead = min(range(1, span + 1), key=lambda i: len(self.slots[(self.cursor + i) % n]))
+      t.due = self.base + ahead * self.tick
+      self.slots[(self.cursor + ahead) % n].append(t)
+    return t
+
+  def _place(self, t): #caller holds `lock`
+    n = len(self.slots)
+    ahead = int((t.due - self.base) / self.tick + .5)
+    ahead = max(1, min(n - 1, ahead)) #anything further out just gets looked at again next time around.
+    self.slots[(self.cursor + ahead) % n].append(t)
+
+  def _run(self):
+    while not self.stopped.is_set():
+      left = self.base + self.tick - time.monotonic()
+      if left > 0:
+        self.stopped.wait(left)
+        continue
+      with self.lock:
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        self.base += self.tick
+        due = self.slots[self.cursor]
+        self.slots[self.cursor] = []
+      for t in due:
+        if t.dead:
+          continue
+        if t.due <= self.base + self.tick / 2: #touched timers have been pushed back; they just get re-placed.
+          try:
+            t.func()
+          except Exception as e:
+            log(2,"Keepalive failed:",repr(e))
+          t.due = self.base + t.interval
+        if not t.dead:
+          with self.lock:
+            self._place(t)
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread and self.thread is not threading.current_thread():
+      self.thread.join()
 
 class VWTPException(Exception):
   pass
@@ -50,6 +114,213 @@ class ETIME(VWTPException):
 class ERETRY(VWTPException):
   pass
 
+class ERefused(VWTPException): #negative channel setup response; usually the gateway's out of channels.
+  pass
+
+SPIN = .0015 #sleep() tends to overshoot by about a millisecond, so the tail end of a gap is busy-waited.
+
+class Pacer: #holds CAN frames to the negotiated minimum inter-frame gap (STmin), with sub-millisecond accuracy.
+  def __init__(self, gap=0):
+    self.gap = gap #seconds; 0 means send at full speed.
+    self.last = 0
+
+  def left(self): #time remaining before the next frame may go out.
+    return self.last + self.gap - time.perf_counter()
+
+  def stamp(self):
+    self.last = time.perf_counter()
+
+  def wait(self): #doesn't stamp; the frame may still queue behind another channel, so the sender stamps once it's out.
+    if self.gap:
+      deadline = self.last + self.gap
+      left = deadline - time.perf_counter()
+      if left > SPIN:
+        time.sleep(left - SPIN)
+      while time.perf_counter() < deadline:
+        pass
+
+class Histogram: #log2-bucketed latency histogram (bucket n holds values under 2**n microseconds); constant-time to update.
+  def __init__(self):
+    self.buckets = [0] * 26
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, secs):
+    b = int(secs * 1000000).bit_length()
+    self.buckets[b if b < 26 else 25] += 1
+    self.count += 1
+    self.total += secs
+    if secs > self.max:
+      self.max = secs
+
+  def merge(self, other):
+    for i in range(len(self.buckets)):
+      self.buckets[i] += other.buckets[i]
+    self.count += other.count
+    self.total += other.total
+    self.max = max(self.max, other.max)
+
+  def percentile(self, p): #upper bound of the bucket holding the p'th percentile, in seconds.
+    want = self.count * p / 100
+    seen = 0
+    for i, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= want:
+        return (1 << i) / 1000000
+    return 0.0
+
+  def dict(self):
+    return {
+      "count": self.count,
+      "mean_ms": (self.total / self.count) * 1000 if self.count else 0,
+      "p50_ms": self.percentile(50) * 1000,
+      "p95_ms": self.percentile(95) * 1000,
+      "max_ms": self.max * 1000,
+      "buckets_us": {1 << i: n for i, n in enumerate(self.buckets) if n}
+    }
+
+#transport counters for a connection (or a whole stack, when merged). plain attribute increments,
+#so it's cheap enough to leave on; counts may be off by one or two under heavy thread contention.
+#response latency per (module, service), used to size timeouts: the 99th percentile times FACTOR, clamped to the caller's bounds.
+#for channel setup, a module without enough history of its own borrows the figure across every module, so a scan still fails
+#fast on modules that aren't there. KWP services don't borrow (pass borrow=False): a module that gave us a channel is there,
+#and a shared figure would only cut off the slower ones. once a module has timed out, a borrowed figure never undercuts the caller's default:
+#a slow module would otherwise keep timing out and never build the history that would fix it.
+#until there's enough history at all, the caller's default applies.
+SAMPLES = 8
+FACTOR = 2
+
+class Latency:
+  def __init__(self):
+    self.hists = {} #{(mod, service): Histogram}; mod None is every module.
+    self.missed = set() #{(mod, service)} that have timed out on a borrowed figure.
+    self.lock = threading.Lock()
+
+  def add(self, mod, service, secs):
+    with self.lock:
+      for key in ((mod, service), (None, service)):
+        if not key in self.hists:
+          self.hists[key] = Histogram()
+        self.hists[key].add(secs)
+
+  def miss(self, mod, service): #a timeout; not a sample, since all it says is "longer than we waited".
+    with self.lock:
+      self.missed.add((mod, service))
+
+  def timeout(self, mod, service, default, floor, ceil, borrow=True):
+    with self.lock:
+      for key in ((mod, service), (None, service)) if borrow else ((mod, service),):
+        h = self.hists.get(key)
+        if h and h.count >= SAMPLES:
+          if key[0] is None and (mod, service) in self.missed:
+            floor = max(floor, default)
+          return min(max(h.percentile(99) * FACTOR, floor), ceil)
+    return default
+
+class VWTPStats:
+  counters = ["tx_frames", "rx_frames", "tx_messages", "rx_messages", "tx_bytes", "rx_bytes",
+    "retransmits", "brks", "ack_timeouts", "reconnects", "length_faults", "short_frames"]
+
+  def __init__(self):
+    for k in self.counters:
+      setattr(self, k, 0)
+    self.ackrtt = Histogram() #last frame of a block -> ACK
+
+  def merge(self, other):
+    for k in self.counters:
+      setattr(self, k, getattr(self, k) + getattr(other, k))
+    self.ackrtt.merge(other.ackrtt)
+
+  def dict(self):
+    ret = {k: getattr(self, k) for k in self.counters}
+    ret["ackrtt"] = self.ackrtt.dict()
+    return ret
+
+  def json(self):
+    return json.dumps(self.dict(), indent=4)
+
+NOTHING = [{"can_id": 0, "can_mask": 0x1FFFFFFF, "extended": True}] #filter for an idle stack; VW diagnostics are all 11-bit.
+
+CONNECT = .3 #seconds to wait for a setup response, until the module's latency is known.
+RECONNECT = .2
+CONNMIN = .1 #bounds on the learned setup timeout.
+CONNMAX = 1
+
+RETRY = util.Retry(deadline=5, tries=10, base=.005, cap=.1) #per block: retransmits after a missed ACK and BRK.
+
+ACKFLOOR = .01 #never wait less than 10ms for an ACK, whatever we've measured.
+
+#per-connection auto-tuning. starts from what the ECU granted, then tunes the block size we send with
+#(AIMD on retransmits) and the ACK timeout (from measured round trips); results persist per part number.
+class Tuner:
+  def __init__(self, conn):
+    self.conn = conn
+    self.key = None
+    self.rtt = None #smoothed ACK round trip
+    self.peak = 0 #decaying worst-case ACK round trip
+    self.clean = 0 #blocks ACKed in a row since the last retransmit
+
+  def granted(self): #called once the parameter response is in.
+    c = self.conn
+    c.blocks = c.blksize
+    c.ackwait = c.acktime
+    if self.key:
+      self.load(self.key)
+
+  def acked(self, rtt):
+    c = self.conn
+    self.rtt = rtt if self.rtt is None else self.rtt * .875 + rtt * .125
+    self.peak = max(rtt, self.peak * .95)
+    c.ackwait = min(c.acktime, max(ACKFLOOR, self.peak * 3))
+    self.clean += 1
+    if self.clean >= 8 and c.blocks < c.blksize: #additive increase
+      c.blocks += 1
+      self.clean = 0
+
+  def missed(self):
+    c = self.conn
+    self.clean = 0
+    if c.blocks == 1: #already sending single frames, so the ECU is choking on frame spacing instead.
+      c.pacer.gap = min(max(c.pacer.gap * 2, .0005), .02)
+    c.blocks = max(1, c.blocks // 2) #multiplicative decrease
+    c.ackwait = c.acktime #back off to the ECU's own timeout until we have fresh measurements.
+    self.peak = max(self.peak, c.acktime / 3)
+    log(5,"Missed ACK, tuning down to block size",c.blocks,"gap (ms)",c.pacer.gap * 1000)
+
+  def load(self, key):
+    self.key = key
+    c = self.conn
+    saved = util.config["vwtp"].get("tuning", {}).get(key)
+    if saved and c.blksize:
+      log(5,"Using learned channel parameters for",key,saved)
+      c.blocks = max(1, min(saved["blocks"], c.blksize))
+      c.ackwait = min(c.acktime, max(ACKFLOOR, saved["ackwait"]))
+      c.pacer.gap = max(c.packival, saved["gap"])
+
+  def save(self):
+    c = self.conn
+    if self.key and c.blksize:
+      util.config["vwtp"].setdefault("tuning", {})[self.key] = {"blocks": c.blocks, "ackwait": c.ackwait, "gap": c.pacer.gap}
+
+class FairLock: #a FIFO ticket lock; threading.Lock makes no ordering promises, so a busy channel could starve the others.
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.ticket = 0
+    self.serving = 0
+
+  def __enter__(self):
+    with self.cond:
+      t = self.ticket
+      self.ticket += 1
+      while t != self.serving:
+        self.cond.wait()
+
+  def __exit__(self, a, b, c):
+    with self.cond:
+      self.serving += 1
+      self.cond.notify_all()
+
 #note: the VWTP stack itself handles the sockets.
 #connections should *never* be instantiated directly!
 #thread-safety: partial. used to terminate connection cleanly from other thread.
@@ -60,8 +331,17 @@ class VWTPConnection:
     self.mod_id = 0 #not set; is set externally.
     self.keepalive = 1 #number of seconds between pings.
     self.framebuf = None
+    self.framepos = 0 #write offset into framebuf.
     self.buffer = queue.Queue()
     self.acks = {} #an ack buffer; separate from the queue to allow for introspection.
+    self.pacer = Pacer() #gap is set from the parameter response.
+    self.aggressive = stack.aggressive if stack else False #ask the ECU for the fastest parameters it'll grant.
+    self.blocks = None #the block size we actually send with; at most `blksize`, tuned down on retransmits.
+    self.ackwait = None #how long we actually wait for an ACK; at most `acktime`, tuned from measured round trips.
+    self.tuner = Tuner(self)
+    self.retry = RETRY
+    self.stats = VWTPStats()
+    self.ackcond = threading.Condition() #woken by the recv thread when an ACK lands, so senders don't sleep out the full acktime.
     self.params = None
     self.callback = callback
     self.stack = stack
@@ -72,7 +352,7 @@ class VWTPConnection:
     self.tseq = 0 #the sequence the ECU is expecting to see
     self._open = False
     self.q = queue.Queue() #used for "await" by the channel setup.
-    self.pinger = threading.Thread(target=pingthread, args=(self,))
+    self.pinger = None #our keepalive on the stack's timer wheel.
     self.reopen = reopen #attempt to automatically re-open a connection (to avoid the car saying "fuck off" while brute-forcing block IDs...)
     self.lock = threading.Lock() #used to suspend sending through disconnects
     self.connected = True
@@ -81,10 +361,7 @@ class VWTPConnection:
     self.fault = False
     self.proto = None
 
-  def open(self):
-    self._open = True
-    util.log(5,"Beginning channel parameter setup")
-    #called when the channel is set up to recieve frames at the designated ID, to start channel setup.
+  def _params(self): #the channel parameter request sent to the ECU on open.
     buf = [None] * 6
     buf[0] = 0xA0
     buf[1] = 15 #block size.
@@ -92,24 +369,47 @@ class VWTPConnection:
     buf[3] = 0xff
     buf[4] = 0x0A #interval between packets 5ms? seems high. (50x 0.1ms scale)
     buf[5] = 0xff
+    if self.aggressive: #we can take frames back-to-back; the ECU's own limits come back in the parameter response.
+      buf[4] = 0x00
+    return buf
+
+  def open(self):
+    self._open = True
+    log(5,"Beginning channel parameter setup")
+    #called when the channel is set up to recieve frames at the designated ID, to start channel setup.
+    buf = self._params()
     self._send(buf)
-    util.log(5,"Setup message sent, awaiting response.")
+    log(5,"Setup message sent, awaiting response.")
     for i in range(6):
       try:
         self.q.get(timeout=.1) #100ms per setup
         break
       except queue.Empty:
-        util.log(6,"Retransmit setup...")
+        log(6,"Retransmit setup...")
         self._send(buf)
     if not self.blksize:
       raise ETIME("Channel setup timeout")
-    if self.connected: #use this to determine "new" open vs "old" open; this is set to True by the constructor, which is not re-called on reconnect.
-      self.pinger.start() #only start the thread if it's not already running.
+    if not self.pinger: #only on the first open; the timer survives reconnects.
+      self.pinger = self.stack.timers.add(.5, self._ping)
     self.connected = True
     self.tx=self._tx
 
+  def _ping(self):
+    if self._open:
+      log(6,"Ping!")
+      try:
+        self._send([0xa3]) #but don't actually *send* anything.
+      except VWTPException: #just die cleanly.
+        self.pinger.cancel()
+    elif not self.reopen: #closed for good, rather than reconnecting.
+      self.pinger.cancel()
+
+  def learn(self, key): #start from (and keep) tuning learned under `key`, usually the module's part number.
+    self.tuner.load(key)
+
   def reconnect(self):
-    util.log(5,"Re-opening connection to:",hex(self.mod_id))
+    log(5,"Re-opening connection to:",hex(self.mod_id))
+    self.stats.reconnects += 1
     self.stack.reconnect(self)
     self.open() #outermost lock doesn't affect this, since it uses primitives directly
     self.connected=True
@@ -118,8 +418,9 @@ class VWTPConnection:
     global DEBUG
     #msg is a can data frame.
     buf = msg #the raw buffer contents of a CAN frame.
+    self.stats.rx_frames += 1
     op = buf[0]
-    buf = buf[1:]
+    buf = memoryview(buf)[1:] #no copy; only the reassembly buffer below takes the bytes.
     if op == 0xA8: #disconnect
       if not self._open: #waiting on a finalizer.
         self.fin.put(None)
@@ -134,23 +435,25 @@ class VWTPConnection:
       pass #FIXME: send parameter response method
     elif op  == 0xA1: #params response
       if self.blksize:
-        util.log(6,"Pong!")
-        #util.log(3,"Potential connection fault: recieved 'parameter response' when already configured!\nDropping it and hoping nothing breaks...")
+        log(6,"Pong!")
+        #log(3,"Potential connection fault: recieved 'parameter response' when already configured!\nDropping it and hoping nothing breaks...")
         return
-      self.params = buf
+      self.params = bytes(buf)
       self.blksize = buf[0] + 1 # 0 is "1 frame"
       scale = [ .1, 1, 10, 100]
       acktime = buf[1] >> 6 #scale is 100ms, 10ms, 1ms, .1ms
       self.acktime = (scale[acktime] * (buf[1] & 0x3F)) * 0.001 #go from ms to s.
       self.packival = (scale[buf[3] >> 6] * (buf[3] & 0x3F)) * 0.001
-      util.log(5,"Parameter response received.")
-      util.log(6,"channel parameters:",
+      self.pacer.gap = self.packival
+      self.tuner.granted()
+      log(5,"Parameter response received.")
+      log(6,"channel parameters:",
           "\nTimeout in ms:",self.acktime * 1000,"\nMinimum Interval between frames in ms:",self.packival * 1000,"\nBlock Size:",self.blksize)
       self.q.put(None) #just stuff *something* in there to break the retry loop
     elif op & 0xf0 == 0xB0 or op & 0xf0 == 0x90:
       if op & 0xf0 == 0x90:
-        util.log(3,"ACK but not ready. this is unhandled, spray and pray!")
-      self.acks[op & 0xf] = True #mark the ack in the sequence table
+        log(3,"ACK but not ready. this is unhandled, spray and pray!")
+      self._ackd(op & 0xf)
     else: #assume it's a data packet.
       seq = op & 0x0f
       if op & 0x20 == 0 and seq == self.seq: #expecting ACK
@@ -161,27 +464,35 @@ class VWTPConnection:
       self.seq += 1
       if self.seq == 0x10:
         self.seq = 0
-      if not self.framebuf: #first frame of a transaction
+      if self.framebuf is None: #first frame of a transaction
         try:
-          self.framelen = struct.unpack(">H", buf[0:2])[0]
-          self.framebuf = bytearray()
-          self.framebuf += buf[2:] #because bytearray.
+          self.framelen = struct.unpack_from(">H", buf, 0)[0]
         except struct.error: #usually means fatal connection error.
-          util.log(2,"Short Frame Fault! opcode:",hex(op))
-          util.log(2,"Frame:",buf)
+          self.stats.short_frames += 1
+          log(2,"Short Frame Fault! opcode:",hex(op))
+          log(2,"Frame:",bytes(buf))
           self.fault = VWTPException("Short Frame Fault.")
           return
-      else:
-        self.framebuf += buf
+        self.framebuf = bytearray(self.framelen) #sized up front from the length header, so the frames below are written in place.
+        self.framepos = 0
+        buf = buf[2:]
+      end = self.framepos + len(buf)
+      self.framebuf[self.framepos:end] = buf #grows the buffer if the ECU sends more than it announced.
+      self.framepos = end
       if op & 0x10 == 0x10:
-        if self.proto == 1 and self.framelen != len(self.framebuf): #"harmless" fault, but only "valid" on KWP.
-          util.log(3,"Frame length mismatch! expected {}, got {}. Attempting to continue...".format(self.framelen, len(self.framebuf)))
-          util.log(4,"Problematic Frame data:",struct.pack("<H",self.framelen) + self.framebuf)
+        if self.framepos != len(self.framebuf): #sent less than announced; drop the unfilled tail.
+          del self.framebuf[self.framepos:]
+        if self.proto == 1 and self.framelen != self.framepos: #"harmless" fault, but only "valid" on KWP.
+          self.stats.length_faults += 1
+          log(3,"Frame length mismatch! expected",self.framelen,"got",self.framepos,"Attempting to continue...")
+          log(4,"Problematic Frame data:",struct.pack("<H",self.framelen) + self.framebuf)
         self.recv(bytes(self.framebuf))
         self.framebuf = None
 
   def recv(self, frame):
-    util.log(5,"Assembled VWTP message:",frame)
+    log(5,"Assembled VWTP message:",frame)
+    self.stats.rx_messages += 1
+    self.stats.rx_bytes += len(frame)
     if self.callback: #if we have a callback, call it
       self.callback(frame)
     else: #else buffer the frames until the reader swings around
@@ -193,7 +504,8 @@ class VWTPConnection:
     self._send(bytes(buf))
 
   def _brk(self):
-    util.log(6,"BRK!")
+    log(6,"BRK!")
+    self.stats.brks += 1
     self._send([0xa4])
 
   def _send(self, blob):
@@ -202,39 +514,77 @@ class VWTPConnection:
     if not self._open and not blob[0] == 0xA8: #ignore this for "disconnect" messages
       raise VWTPException("Attempted to write to closed connection")
     if self.tx:
-      frame = can.Message(arbitration_id=self.tx, data=blob, extended_id=False)
+      frame = can.Message(arbitration_id=self.tx, data=blob, is_extended_id=False)
     else:
-      frame = can.Message(arbitration_id=0x200, data=blob, extended_id=False)
+      frame = can.Message(arbitration_id=0x200, data=blob, is_extended_id=False)
+    self.stats.tx_frames += 1
     self.stack.send(frame)
 
-  def _sendblk(self, blk):
+  #shared by the threaded and asyncio connections; splits a VWTP message into blocks of CAN frame payloads.
+  def _segment(self, msg): #splits a message into blocks of frame payloads; the payloads are memoryview slices, not copies.
+    if self.proto == 1: #for KWP only, prepend the length field to the buffer before splitting it apart.
+      buf = bytearray(len(msg) + 2)
+      struct.pack_into(">H", buf, 0, len(msg))
+      buf[2:] = msg
+      mv = memoryview(buf)
+    else:
+      mv = memoryview(msg)
+    frames = [mv[i:i+7] for i in range(0, len(mv), 7)]
+    return [frames[i:i+self.blocks] for i in range(0, len(frames), self.blocks)]
+
+  def _frames(self, blk, last): #yields the CAN frames of a block with opcodes and sequence numbers applied.
     seq = self.tseq
-    wait = False
     for i in range(len(blk)):
-      f = blk[i]
-      if len(f) < 7: #last CAN frame
+      if last and i == len(blk) - 1: #last CAN frame of the message
         op = 0x10 + seq
-        wait = True
-      elif i == self.blksize: #last frame in block, want an ACK
-        wait = True
+      elif i == len(blk) - 1: #last frame in block, want an ACK
         op = seq
       else: #normal data frame
-        blk = 0
         op = 0x20 + seq
       seq += 1
       if seq == 0x10: #clamp to nibble.
         seq = 0
-      self._send(bytes([op]) + f)
-      if wait:
-        self.tseq = seq
-        return self._await(seq)
+      f = bytearray(len(blk[i]) + 1) #python-can keeps a bytearray by reference instead of copying it, so this is the frame's only copy.
+      f[0] = op
+      f[1:] = blk[i]
+      yield f
+    self.tseq = seq
+
+  def _sendblk(self, blk, last):
+    for f in self._frames(blk, last):
+      self.pacer.wait() #honour the ECU's STmin; slow ECUs drop frames otherwise, which costs a BRK and a retransmit.
+      with self.stack.txlock: #take turns with other channels per frame, so one channel's STmin gaps don't hold up the rest.
+        self._send(f)
+        self.pacer.stamp()
+    sent = time.perf_counter()
+    if self._await(self.tseq):
+      self._acked(time.perf_counter() - sent)
+      return True
+    self._missed()
+    return False
+
+  def _acked(self, rtt):
+    self.stats.ackrtt.add(rtt)
+    self.tuner.acked(rtt)
+
+  def _missed(self):
+    self.stats.ack_timeouts += 1
+    self.tuner.missed()
+
+  def _ackd(self, seq): #called from the recv thread when an ACK arrives.
+    with self.ackcond:
+      self.acks[seq] = True #mark the ack in the sequence table
+      self.ackcond.notify_all()
 
   def _await(self, seq): #a short little helper stub to await acks.
-    if not seq in self.acks:
-      time.sleep(self.acktime) #the actual tomeout value in ms.
-    if not seq in self.acks: #not recieved in time.
-      return False
-    del self.acks[seq]
+    deadline = time.monotonic() + self.ackwait #the (tuned) ACK timeout, as a hard deadline.
+    with self.ackcond:
+      while not seq in self.acks:
+        left = deadline - time.monotonic()
+        if left <= 0: #not recieved in time.
+          return False
+        self.ackcond.wait(left)
+      del self.acks[seq]
     return True
 
   #note: these send *VWTP frames*! they are *arbitrary bytes-like buffers*
@@ -244,28 +594,27 @@ class VWTPConnection:
     if not self.connected and self.reopen: #blocking reconnect triggered in recv thread is a *bad* idea. deadlocks abound. do it here.
       self.reconnect()
     self.sending = True
-    mv = msg
-    if proto == 1: #for KWP only, prepend the length field to the buffer before splitting it apart.
-      mv = struct.pack(">H",len(mv)) + mv 
-    buf = []
-    for i in range(0, (len(mv) + 6) // 7, 7): #round up
-      buf.append(mv[i:i+7])
-    blocks = []
-    for i in range(0, (len(buf) + self.blksize - 1) // self.blksize, self.blksize): #round up
-      blocks.append(buf[i:i+self.blksize])
-    for blk in blocks:
-      retry = 10
+    if self.pinger:
+      self.pinger.touch() #no need to ping a channel that's carrying traffic.
+    self.stats.tx_messages += 1
+    self.stats.tx_bytes += len(msg)
+    blocks = self._segment(msg)
+    for n, blk in enumerate(blocks):
+      attempts = self.retry(base=max(self.pacer.gap, self.retry.base))
       sent = False
       while not sent and self.sending: #repeat blocks that time out
-       with self.lock: #avoid "sliced" blocks if a reconnect occurs in the middle. finish flushing the block and bail first.
-        sent = self._sendblk(blk)
-        retry -= 1
-        if not sent: #missed an ACK, send a BRK to flush the buffers.
-          self._brk()
-        if retry == 0: #not an assert, otherwise "optimized" use would spinlock by infinitely trying to send.
-          raise ERETRY("Retry limit exceeded, aborting!")
+        with self.lock: #avoid "sliced" blocks if a reconnect occurs in the middle. finish flushing the block and bail first.
+          sent = self._sendblk(blk, n == len(blocks) - 1)
+          if not sent: #missed an ACK, send a BRK to flush the buffers.
+            self.stats.retransmits += 1
+            self._brk()
+        if not sent:
+          pause = attempts.pause()
+          if pause is None: #not an assert, otherwise "optimized" use would spinlock by infinitely trying to send.
+            raise ERETRY("Retry limit exceeded, aborting!")
+          time.sleep(pause) #outside the lock, so a reconnect can get in.
       if not self.sending:
-        util.log(5,"Send cut short by reconnect.")
+        log(5,"Send cut short by reconnect.")
         raise VWTPException("Send cut short by reconnect.")
     self.sending = False
 
@@ -277,9 +626,15 @@ class VWTPConnection:
     if self._open: #don't close the socket twice.
       self._open = False
       if not check or not self.reopen:
-        self.stack.disconnect(self) #call back to our stack manager for cleanup
-        self.pinger.join() #and wait for our pinger to die (if it should...)
-        self.finalize()
+        self.reopen = False #an explicit close is final; otherwise the pinger spins forever waiting for a reconnect.
+        self.tuner.save()
+        if log.enabled(5): #arguments are built before the level check, and the JSON dump isn't free.
+          log(5,"Channel statistics for",hex(self.mod_id),self.stats.json())
+        self.stack.disconnect(self, not check) #call back to our stack manager for cleanup; a remote disconnect's already been answered.
+        if self.pinger:
+          self.pinger.cancel()
+        if not check: #nothing more is coming on a remote disconnect.
+          self.finalize()
 
   def finalize(self): #wait for ECU to ack disconnect
     try:
@@ -302,23 +657,34 @@ class VWTPConnection:
     if self._open:
       print("WARN: VWTP connection garbage-collected before being closed!")
       self.reopen = False
-      self.pinger.join() #if we're being GCed, the stack object's already gone.
+      if self.pinger:
+        self.pinger.cancel() #if we're being GCed, the stack object's already gone.
 
 class VWTPStack:
-  def __init__(self,socket,sync=True):
+  def __init__(self,socket,sync=True,aggressive=None):
     self.socket = socket
+    if aggressive is None:
+      aggressive = util.config["vwtp"].get("aggressive", False)
+    self.aggressive = aggressive #channel parameter negotiation mode for new connections.
     #a sparse list of connections based on recv address.
     self.connections = {}
     self.framebuf = {} #a sparse frame buffer based on recieved address. *must* register a dest before messages will be buffered!
     self.sync = sync
     self.open = True
     #frame buffers and connection table modifications are behind this lock.
-    self.buflock = threading.Lock()
+    self.buflock = threading.RLock() #re-entrant: a remote disconnect tears the channel down from inside `_recv`.
+    self.txlock = FairLock() #frame-level turn taking between channels.
+    self.timers = TimerWheel() #keepalives for every channel and KWP session on this stack.
+    self.latency = Latency() #connect and KWP response times, per module.
+    self.closed = {} #mod_id -> VWTPStats of connections that have since closed, so the summary covers the whole session.
     self.next = 0x300
+    with self.buflock: #idle until something registers; broadcast traffic shouldn't wake a fresh stack either.
+      self._refilter()
 
     if sync:
-      #socket is synchronous, start the listener thread.
-      self.recvthread = threading.Thread(target=recvthread, args=(self,))
+      #VWTP was architectured for an asynchronous socket, but python sockets are synchronous,
+      #so we need a thread to do that for us.
+      self.recvthread = canrx.Receiver(socket, self._recv)
       self.recvthread.start()
     else:
       self.recvthread = None
@@ -335,135 +701,322 @@ class VWTPStack:
       if dest in self.framebuf:
         return
       else:
-        util.log(6,"Registering simple-frame handler for dest:",dest)
+        log(6,"Registering simple-frame handler for dest:",dest)
         self.framebuf[dest] = queue.Queue()
+        self._refilter()
 
   def _unregister(self, dest): #note: only one user of an address can exist at a time!
     global DEBUG
     with self.buflock:
       if dest in self.framebuf:
         del self.framebuf[dest]
-        util.log(6,"Unregistering simple-frame handler for dest:",dest)
+        log(6,"Unregistering simple-frame handler for dest:",dest)
+        self._refilter()
+
+  #keeps the socket's (kernel or hardware) filters in sync with the IDs we actually listen on, so broadcast
+  #traffic never wakes the interpreter. caller must hold `buflock`.
+  def _refilter(self):
+    setfilters = getattr(self.socket, "set_filters", None)
+    if not setfilters: #not a python-can bus (ie: test harnesses)
+      return
+    ids = list(self.framebuf.keys()) + list(self.connections.keys())
+    if not ids: #python-can takes an empty list as "everything"; the closest thing to nothing is one extended ID nobody uses.
+      setfilters(NOTHING)
+      return
+    setfilters([{"can_id": i, "can_mask": 0x7FF, "extended": False} for i in ids])
 
   def _recv(self,msg):
     global DEBUG
     with self.buflock: #fix a race condition when frames are duplicated, a time-of-check race.
-      if msg.arbitration_id in self.connections:
-        util.log(6,"Got VWTP subframe:",msg)
-        self.connections[msg.arbitration_id]._recv(msg.data) #note: _recv is for CAN frame data, recv is called when a *VWTP* frame is constructed.
+      conn = self.connections.get(msg.arbitration_id)
+      if conn: #reserved channels are None until the ECU answers the setup request.
+        log(6,"Got VWTP subframe:",msg)
+        conn._recv(msg.data) #note: _recv is for CAN frame data, recv is called when a *VWTP* frame is constructed.
       elif msg.arbitration_id in self.framebuf:
-        util.log(5,"Got link control frame:",msg)
+        log(5,"Got link control frame:",msg)
         self.framebuf[msg.arbitration_id].put(msg.data)
 
   def send(self,msg):
-    util.log(6,"Sending frame:",msg)
+    log(6,"Sending frame:",msg)
     self.socket.send(msg)
 
-  def connect(self,dest,callback=None,proto=1): #note: the *logical* destination, also known as the unit identifier
-    util.log(5,"Connecting to ECU:",dest)
-    #connect frame format:
-    #0x0: component ID
-    #0x1: opcode (0xC0: setup request, 0xD0: positive respose, 0xD6..D8: negative response)
-    #0x2: RX ID low
-    #0x3: RX ID high #note: both high bytes contain an additional flag bit at 0x10(?) that denotes 
-    #0x4: TX ID low  #ID validity; with '0' being valid.
-    #0x5: TX ID high
-    #0x6: Application type, 0x01 for KWP(?)
-    rx = None
-    self._register(0x200 + dest) #this needs to be outside the lock, because it uses it itself.
-    with self.buflock: #yes, the whole connection is inside the lock; mostly for concurrency issues.
+  #connect frame format:
+  #0x0: component ID
+  #0x1: opcode (0xC0: setup request, 0xD0: positive respose, 0xD6..D8: negative response)
+  #0x2: RX ID low
+  #0x3: RX ID high #note: both high bytes contain an additional flag bit at 0x10(?) that denotes
+  #0x4: TX ID low  #ID validity; with '0' being valid.
+  #0x5: TX ID high
+  #0x6: Application type, 0x01 for KWP(?)
+  def _setup(self, dest, rx, proto): #builds the channel setup request; shared with the asyncio stack.
+    frame = [None] * 7
+    frame[0] = dest
+    frame[1] = 0xC0 #setup request
+    frame[2] = 0
+    frame[3] = 0x10 #high nibble of high byte set to invalid
+    frame[4] = rx & 255 #low byte of address
+    frame[5] = (rx >> 8) & 255 #high nibble, 0x300-310 are the usually seen ones
+    frame[6] = proto #default is KWP transport
+    return can.Message(arbitration_id=0x200, data=frame, is_extended_id=False)
+
+  def _setupresp(self, dest, blob): #validates a channel setup response, returning the TX address the ECU gave us.
+    #note: byte 0 of the response is the *tester's* address (0), the module is implied by the 0x200 + dest ID it arrived on.
+    if blob[1] != 0xd0: #invalid or negative connect response.
+      raise ERefused("Negative or invalid response to connect: {}".format(blob[1]))
+    if blob[5] & 0x10: #shouldn't happen, but trap it if it does.
+      raise VWTPException("ECU gave us an invalid TX address?")
+    return (blob[5] * 256) + blob[4]
+
+  def _alloc(self): #reserves a free RX channel; the reservation is replaced by the connection once the ECU answers.
+    with self.buflock:
       addr = self.next
       idx = 0
       while addr in self.connections: #if the chosen address is in-use, cycle it.
         addr += 1
-        if addr == 0x310:
+        if addr == 0x300 + CHANNELS:
           addr = 0x300
         idx += 1
-        if idx == 11:
+        if idx == CHANNELS:
           raise VWTPException("No free RX channels")
-      self.next = addr + 1 if addr != 0x30f else 0x300
-      rx = addr
-      #self._register(0x200 + dest) #register the response address so we don't drop frames...
-      frame = [None] * 7
-      frame[0] = dest
-      frame[1] = 0xC0 #setup request
-      frame[2] = 0
-      frame[3] = 0x10 #high nibble of high byte set to invalid
-      frame[4] = rx & 255 #low byte of address
-      frame[5] = (rx / 256) & 255 #high nibble, 0x300-310 are the usually seen ones
-      frame[6] = proto #default is KWP transport
-      msg = can.Message(arbitration_id=0x200, data=frame, is_extended_id=False)
-      self.send(msg)
+      self.next = addr + 1 if addr != 0x2ff + CHANNELS else 0x300
+      self.connections[addr] = None
+      self._refilter()
+      return addr
+
+  def _free(self, rx):
+    with self.buflock:
+      if self.connections.get(rx, True) is None:
+        del self.connections[rx]
+        self._refilter()
+
+  def connect(self,dest,callback=None,proto=1): #note: the *logical* destination, also known as the unit identifier
+    log(5,"Connecting to ECU:",dest)
+    rx = None
+    try:
       try:
-        msg = self.framebuf[0x200+dest].get(timeout = .3) #300ms timeout for connect interrogation.
-      except queue.Empty:
-        raise ETIME("Channel Connect timeout")
-      self._unregister(0x200 + dest)
-      blob = msg
-      assert blob[0] == dest, "Recieved connect response for different module? {}".format(blob[0]) #how would this even be *possible*? should still catch it though.
-      assert blob[1] == 0xd0, "Negative or invalid response to connect: {}".format(blob[1]) #invalid or negative connect response.
-      assert blob[5] & 0x10 == 0, "ECU gave us an invalid TX address?" #shouldn't happen, but trap it if it does.
-      tx = (blob[5] * 256) + blob[4]
+        self._register(0x200 + dest)
+        rx = self._alloc() #only the channel table needs the lock; the handshake itself can overlap with other connects.
+        timeout = self.latency.timeout(dest, "connect", CONNECT, CONNMIN, CONNMAX)
+        self.send(self._setup(dest, rx, proto))
+        sent = time.perf_counter()
+        try:
+          msg = self.framebuf[0x200+dest].get(timeout = timeout)
+        except queue.Empty:
+          self.latency.miss(dest, "connect")
+          raise ETIME("Channel Connect timeout")
+        self.latency.add(dest, "connect", time.perf_counter() - sent)
+      finally:
+        self._unregister(0x200 + dest)
+      tx = self._setupresp(dest, msg)
       conn = VWTPConnection(self,tx,callback) #tx is usually 0x740.
       conn.rx = rx
       conn.mod_id = dest
-      self.connections[rx] = conn #pin the connection to the RX address we picked.
-      util.log(5,"Connected")
       conn.proto = proto #inform the connection object what "quirks" it needs to apply.
+      with self.buflock:
+        self.connections[rx] = conn #pin the connection to the RX address we picked.
+    except BaseException:
+      if rx is not None:
+        self._free(rx)
+      raise
+    log(5,"Connected")
+    try:
       conn.open()
-      return conn
+    except BaseException: #the ECU gave us a channel but no parameters; hand it back rather than leak the RX slot.
+      conn.reopen = False
+      conn.close()
+      raise
+    return conn
 
   def _connect(self, rx, tx, proto=None, callback=None):
-    util.log(5, "Opening pre-established communication channel...")
+    log(5, "Opening pre-established communication channel...")
     VWTPConnection(self, tx, callback)
     conn.rx = rx
     conn.proto = proto #inform connection structure which quirks to apply.
     with self.buflock:
       self.connections[rx] = conn
     conn.open()
-    util.log(5, "Opened.")
+    log(5, "Opened.")
     return conn
   def reconnect(self, conn, proto=1):
     dest = conn.mod_id #locking is unnecessary here, since we aren't peering into connection structures.
-    util.log(5,"Re-connecting to ECU:",hex(dest))
-    frame = [None] * 7
-    frame[0] = dest
-    frame[1] = 0xC0 #setup request
-    frame[2] = 0
-    frame[3] = 0x10 #high nibble of high byte set to invalid
-    frame[4] = conn.rx
-    frame[5] = (conn.rx / 256) & 0x0F #re-use the RX address we already allocated.
-    frame[6] = proto #default is KWP transport
-    with self.buflock: #only need to hold this until we unregister link-control, since we're not modifying or using the connection table (RX address already allocated)
-      self._register(0x200 + dest) #register the response address so we don't drop frames...
-      msg = can.Message(arbitration_id=0x200, data=frame, is_extended_id=False)
+    log(5,"Re-connecting to ECU:",hex(dest))
+    msg = self._setup(dest, conn.rx, proto) #re-use the RX address we already allocated.
+    self._register(0x200 + dest) #register the response address so we don't drop frames...
+    try: #no lock needed, since we're not modifying or using the connection table (RX address already allocated)
+      timeout = self.latency.timeout(dest, "connect", RECONNECT, CONNMIN, CONNMAX)
       self.send(msg)
+      sent = time.perf_counter()
       try:
-        msg = self.framebuf[0x200+dest].get(timeout = .2) #200ms timeout for connect interrogation.
+        msg = self.framebuf[0x200+dest].get(timeout = timeout)
       except queue.Empty:
+        self.latency.miss(dest, "connect")
         raise ETIME("Reconnect Timeout")
+      self.latency.add(dest, "connect", time.perf_counter() - sent)
+    finally:
       self._unregister(0x200 + dest)
-    blob = msg
-    assert blob[5] & 0x10 == 0, "ECU gave us an invalid TX address?" #shouldn't happen, but trap it if it does.
-    tx = (blob[5] * 256) + blob[4]
+    tx = self._setupresp(dest, msg)
     conn.tx = tx #give it the new TX address.
-    util.log(5,"Reconnected")
+    log(5,"Reconnected")
     
-  def disconnect(self,con):
-    con._send([0xA8])
-    for k,v in self.connections.items():
-      if v is con:
-        util.log(5, "Disconnected from ECU channel:",k)
-        try:
+  def disconnect(self, con, send=True): #send=False when the ECU hung up and `_recv` has already answered it.
+    if send:
+      con._send([0xA8])
+    with self.buflock:
+      for k,v in self.connections.items():
+        if v is con:
+          log(5, "Disconnected from ECU channel:",k)
           del self.connections[k]
-        except KeyError:
-          pass #this just means we've already disconnected.
-        break
+          self.closed.setdefault(con.mod_id, VWTPStats()).merge(con.stats)
+          self._refilter()
+          break
+
+  def stats(self): #live summary; per module (open and closed channels) plus a total.
+    with self.buflock:
+      mods = {k: VWTPStats() for k in self.closed}
+      for k, v in self.closed.items():
+        mods[k].merge(v)
+      for conn in self.connections.values():
+        if conn:
+          mods.setdefault(conn.mod_id, VWTPStats()).merge(conn.stats)
+    total = VWTPStats()
+    for v in mods.values():
+      total.merge(v)
+    ret = {"total": total.dict(), "modules": {hex(k): v.dict() for k, v in mods.items()}}
+    return ret
+
+  def dumpstats(self, path):
+    with open(path, "w") as fd:
+      fd.write(json.dumps(self.stats(), indent=4))
 
   def __enter__(self):
     return self
   def __exit__(self,a,b,c):
+    self.close()
+
+  def close(self): #stops the receive and timer threads; open channels aren't told, so close those first.
+    path = util.config["vwtp"].get("stats") #optional: where to dump the session's transport statistics.
+    if path:
+      self.dumpstats(os.path.expanduser(path))
     self.open = False
+    self.timers.stop()
     if self.recvthread:
-      self.recvthread.join()
+      self.recvthread.stop()
       self.recvthread = None
+    if hasattr(self.socket, "set_filters"):
+      self.socket.set_filters(None) #hand the socket back unfiltered; it's usually shared with OBD2.
+
+REFUSALS = 2 #refusals from different modules, with channels held, before the scheduler takes the gateway to be full.
+PROBE = 5 #seconds between attempts to win back a channel after the limit came down.
+
+#keeps up to `limit` channels open at once to different ECUs on one stack, with a worker thread per open channel.
+#fairness on the bus comes from the stack's `txlock`; channels interleave frame-by-frame.
+#the gateway's real channel count isn't advertised; refused setups from different ECUs with channels open lower `limit`
+#to match, and it creeps back up one channel at a time in case they were only busy.
+class VWTPScheduler:
+  def __init__(self, stack, limit=CHANNELS, proto=1):
+    self.stack = stack
+    self.limit = limit
+    self.ceiling = limit #what `limit` climbs back towards after a refusal lowered it.
+    self.proto = proto
+    self.lock = threading.Lock()
+    self.slots = threading.Condition(self.lock) #signalled whenever a channel is given back.
+    self.opening = 0 #setups in flight; they hold a slot too.
+    self.active = {} #dest -> connection
+    self.refused = set() #dests refused with channels held, since the last successful open.
+    self.changed = 0 #monotonic time `limit` last moved.
+    self.released = 0 #channels given back so far; a refused dest waits for this to move before asking again.
+
+  @property
+  def inuse(self):
+    return len(self.active)
+
+  @property
+  def free(self):
+    with self.lock:
+      return self.limit - len(self.active) - self.opening
+
+  def open(self, dest, callback=None): #blocks until a channel slot is free.
+    with self.slots:
+      while len(self.active) + self.opening >= self.limit:
+        self.slots.wait()
+      self.opening += 1
+    try:
+      conn = self.stack.connect(dest, callback, self.proto)
+    except BaseException as e:
+      with self.slots:
+        self.opening -= 1
+        held = len(self.active) + self.opening
+        if isinstance(e, ERefused) and held: #with none held, it's that ECU refusing, not the gateway.
+          self.refused.add(dest)
+          #one module can refuse its own channel for reasons of its own; two different ones in a row means the gateway's full.
+          #only granted channels count towards the new limit: setups still in flight may be refused too.
+          granted = len(self.active)
+          if len(self.refused) >= REFUSALS and 0 < granted < self.limit:
+            log(5,"Gateway refused channels with",granted,"open, limiting to that")
+            self.limit = granted
+            self.changed = time.monotonic()
+        self.slots.notify_all()
+      raise
+    with self.slots:
+      self.opening -= 1
+      self.active[dest] = conn
+      self.refused.clear()
+    return conn
+
+  def release(self, conn):
+    with self.lock:
+      if self.active.get(conn.mod_id) is conn:
+        self.active[conn.mod_id] = None #keeps its slot until the gateway's actually freed the channel.
+      else:
+        return #already released.
+    try:
+      conn.reopen = False
+      conn.close()
+    finally:
+      with self.slots:
+        del self.active[conn.mod_id]
+        self.released += 1
+        if self.limit < self.ceiling and time.monotonic() - self.changed > PROBE: #the gateway may have channels back; try one more.
+          self.limit += 1
+          self.changed = time.monotonic()
+        self.slots.notify_all()
+
+  def run(self, dests, func, done=None): #calls func(dest, conn) for every dest, up to `limit` at once. returns {dest: result or exception}
+    #`done(dest, result or exception)` is called from the worker threads as each one finishes.
+    work = queue.Queue()
+    for dest in dests:
+      work.put((dest, None))
+    results = {}
+    retried = {} #dest -> times requeued after a refusal
+    def worker():
+      while True:
+        try:
+          dest, seen = work.get_nowait()
+        except queue.Empty:
+          return
+        if seen is not None: #refused while the gateway was busy; asking again before it's freed a channel would just burn a retry.
+          with self.slots:
+            while self.released == seen and (self.active or self.opening):
+              self.slots.wait()
+        try:
+          conn = self.open(dest)
+          try:
+            results[dest] = func(dest, conn)
+          finally:
+            self.release(conn)
+        except ERefused as e:
+          if retried.get(dest, 0) < REFUSALS and (self.active or self.opening): #maybe out of channels rather than refused outright.
+            retried[dest] = retried.get(dest, 0) + 1 #bounded, so a module that always refuses doesn't spin until the rest finish.
+            work.put((dest, self.released))
+            continue
+          results[dest] = e
+        except Exception as e:
+          results[dest] = e
+        if done:
+          done(dest, results[dest])
+    threads = [threading.Thread(target=worker) for i in range(min(self.limit, work.qsize()))]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    return results
@@ -0,0 +1,215 @@
+import asyncio
+import can
+import time
+import util
+import vwtp
+from vwtp import VWTPException, ETIME, ERETRY
+
+log = util.getLogger(__name__)
+
+#asyncio flavour of the VWTP stack. framing, opcodes and setup frames are shared with vwtp.py;
+#this only replaces the threads (receive thread, keepalive timers) and blocking waits with coroutines,
+#so a single event loop can drive every channel on the bus.
+
+class LoopQueue(asyncio.Queue):
+  #the shared `_recv` code calls `put` synchronously; from inside the loop that's just `put_nowait`.
+  def put(self, item):
+    self.put_nowait(item)
+
+#note: like the threaded stack, connections should *never* be instantiated directly.
+#thread-safety: none. everything must run on the stack's event loop.
+class AsyncVWTPConnection(vwtp.VWTPConnection):
+  def __init__(self, stack, chan_id, callback=None):
+    super().__init__(stack, chan_id, callback, reopen=False) #no transparent reconnects; callers can just reconnect themselves.
+    self.buffer = LoopQueue()
+    self.q = LoopQueue()
+    self.fin = LoopQueue()
+    self.pinger = None
+    self.ackev = asyncio.Event()
+    self.sendlock = asyncio.Lock() #only one coroutine may send a VWTP frame at a time.
+
+  async def open(self):
+    self._open = True
+    log(5,"Beginning channel parameter setup")
+    buf = self._params()
+    self._send(buf)
+    log(5,"Setup message sent, awaiting response.")
+    for i in range(6):
+      try:
+        await asyncio.wait_for(self.q.get(), .1) #100ms per setup
+        break
+      except asyncio.TimeoutError:
+        log(6,"Retransmit setup...")
+        self._send(buf)
+    if not self.blksize:
+      raise ETIME("Channel setup timeout")
+    self.pinger = asyncio.ensure_future(self._ping())
+    self.tx = self._tx
+
+  async def _ping(self):
+    try:
+      while self._open:
+        await asyncio.sleep(.5)
+        if self._open:
+          log(6,"Ping!")
+          self._send([0xa3])
+    except VWTPException: #just die cleanly.
+      pass
+
+  def _ackd(self, seq):
+    self.acks[seq] = True
+    self.ackev.set()
+
+  async def _await(self, seq):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + self.ackwait
+    while not seq in self.acks:
+      left = deadline - loop.time()
+      if left <= 0: #not recieved in time.
+        return False
+      self.ackev.clear()
+      try:
+        await asyncio.wait_for(self.ackev.wait(), left)
+      except asyncio.TimeoutError:
+        pass
+    del self.acks[seq]
+    return True
+
+  async def send(self, msg):
+    if self.fault:
+      raise self.fault
+    async with self.sendlock:
+      self.sending = True
+      self.stats.tx_messages += 1
+      self.stats.tx_bytes += len(msg)
+      blocks = self._segment(msg)
+      for n, blk in enumerate(blocks):
+        attempts = self.retry(base=max(self.pacer.gap, self.retry.base))
+        while True:
+          for f in self._frames(blk, n == len(blocks) - 1):
+            left = self.pacer.left()
+            if left > 0: #no busy-waiting on the loop; asyncio's timer resolution is the best we get here.
+              await asyncio.sleep(left)
+            self.pacer.stamp()
+            self._send(f)
+          sent = time.perf_counter()
+          if await self._await(self.tseq):
+            self._acked(time.perf_counter() - sent)
+            break
+          self._missed()
+          self.stats.retransmits += 1
+          self._brk() #missed an ACK, send a BRK to flush the buffers.
+          pause = attempts.pause()
+          if pause is None:
+            raise ERETRY("Retry limit exceeded, aborting!")
+          await asyncio.sleep(pause)
+        if not self.sending:
+          log(5,"Send cut short by disconnect.")
+          raise VWTPException("Send cut short by disconnect.")
+      self.sending = False
+
+  async def read(self, timeout=None): #note: this is *ONLY VALID* if there's no callback registered.
+    return await asyncio.wait_for(self.buffer.get(), timeout)
+
+  def close(self, check=False): #synchronous, since the shared `_recv` calls it on a remote disconnect.
+    if self._open:
+      self._open = False
+      self.tuner.save()
+      if log.enabled(5): #arguments are built before the level check, and the JSON dump isn't free.
+        log(5,"Channel statistics for",hex(self.mod_id),self.stats.json())
+      self.stack.disconnect(self, not check) #a remote disconnect's already been answered by `_recv`.
+      if self.pinger:
+        self.pinger.cancel()
+
+  async def aclose(self):
+    self.close()
+    try:
+      await asyncio.wait_for(self.fin.get(), .1) #wait for ECU to ack disconnect
+    except asyncio.TimeoutError:
+      pass
+
+  async def __aenter__(self):
+    return self
+  async def __aexit__(self, a, b, c):
+    await self.aclose()
+
+  def __del__(self):
+    if self._open:
+      print("WARN: VWTP connection garbage-collected before being closed!")
+
+class AsyncVWTPStack(vwtp.VWTPStack):
+  def __init__(self, socket, aggressive=None):
+    super().__init__(socket, sync=False, aggressive=aggressive)
+    self.reader = None
+    self.notifier = None
+
+  def start(self): #spin up the reader coroutine; must be called from inside the event loop.
+    buf = can.AsyncBufferedReader()
+    self.notifier = can.Notifier(self.socket, [buf], loop=asyncio.get_running_loop()) #uses the loop's own reader on sockets with a file descriptor, no extra thread.
+    self.reader = asyncio.ensure_future(self._reader(buf))
+
+  async def _reader(self, buf):
+    async for msg in buf:
+      self._recv(msg)
+
+  def _register(self, dest):
+    with self.buflock:
+      if not dest in self.framebuf:
+        log(6,"Registering simple-frame handler for dest:",dest)
+        self.framebuf[dest] = LoopQueue()
+        self._refilter()
+
+  async def connect(self, dest, callback=None, proto=1):
+    log(5,"Connecting to ECU:",dest)
+    rx = None
+    try:
+      try:
+        self._register(0x200 + dest)
+        rx = self._alloc()
+        timeout = self.latency.timeout(dest, "connect", vwtp.CONNECT, vwtp.CONNMIN, vwtp.CONNMAX)
+        self.send(self._setup(dest, rx, proto))
+        sent = time.perf_counter()
+        try:
+          msg = await asyncio.wait_for(self.framebuf[0x200 + dest].get(), timeout)
+        except asyncio.TimeoutError:
+          self.latency.miss(dest, "connect")
+          raise ETIME("Channel Connect timeout")
+        self.latency.add(dest, "connect", time.perf_counter() - sent)
+      finally:
+        self._unregister(0x200 + dest)
+      tx = self._setupresp(dest, msg)
+      conn = AsyncVWTPConnection(self, tx, callback)
+      conn.rx = rx
+      conn.mod_id = dest
+      conn.proto = proto
+      with self.buflock:
+        self.connections[rx] = conn
+    except BaseException:
+      if rx is not None:
+        self._free(rx)
+      raise
+    log(5,"Connected")
+    try:
+      await conn.open()
+    except BaseException: #the ECU gave us a channel but no parameters; hand it back rather than leak the RX slot.
+      conn.close()
+      raise
+    return conn
+
+  async def __aenter__(self):
+    self.start()
+    return self
+  async def __aexit__(self, a, b, c):
+    for conn in list(self.connections.values()):
+      if conn:
+        await conn.aclose()
+    self.close()
+
+  def close(self): #the reader instead of the receive thread; channels aren't told, so close those first.
+    if self.notifier:
+      self.notifier.stop()
+      self.notifier = None
+    if self.reader:
+      self.reader.cancel()
+      self.reader = None
+    super().close()
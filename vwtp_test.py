@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import vwtp
 import can
+import time
+from fake_ecu import FakeECU
 #NOTE: this "replays" the transactions seen in jazdw's article on VWTP
 #to verify that the VWTP stack is at least *mostly* working.
 
@@ -9,13 +11,17 @@ sent = None
 def _send(self,frame):
   global sent
   sent = frame
-  if frame[0] & 0x20 == 0: #if it wants an ACK, give it one now to avoid a deadlock.
+  if frame[0] == 0xA0: #parameter request; "respond" with the ECU parameters.
+    self._recv(bytearray([0xA1,0x0F,0x8A,0xFF,0x32,0xFF])) #connections take the frame data; only the stack sees Messages.
+  elif frame[0] & 0x20 == 0: #if it wants an ACK, give it one now to avoid a deadlock.
     seq = (frame[0] + 1) & 0xf
-    self._recv(can.Message(arbitration_id=0x300, data=[0xB0 + seq]))
+    self._recv(bytearray([0xB0 + seq]))
 
 class FakeBus:
-  def __init__(self, stack):
-    self.stack = stack
+  def __init__(self):
+    self.stack = None
+  def recv(self, timeout=None): #nothing arrives on its own; everything is fed in by hand.
+    time.sleep(timeout or 0)
   def send(self, msg):
     dest = msg.data[0]
     frame = [None] * 7
@@ -28,18 +34,124 @@ class FakeBus:
     frame[6] = 1 #default is KWP transport
     self.stack._recv(can.Message(arbitration_id=0x200 + dest, data=frame, is_extended_id=False)) #use recursion to avoid a deadlock
 
+real = vwtp.VWTPConnection._send
 vwtp.VWTPConnection._send = _send #hook the relevant methods to avoid needing a CAN driver.
 
-stack = vwtp.VWTPStack(None)
-stack.socket = FakeBus(stack)
+bus = FakeBus()
+stack = vwtp.VWTPStack(bus)
+bus.stack = stack
 
-conn = stack.connect(1) #"ECU"
-conn.open()
-conn._recv(can.Message(arbitration_id=0x300, data=[0xA1,0x0F,0x8A,0xFF,0x32,0xFF])) #"respond" with the ECU parameters
+conn = stack.connect(1) #"ECU"; connecting also runs the parameter setup, which _send answers.
 conn.send(b'\x10\x89') #startDiagnosticSession service with manufacturer-defined mode parameter.
 assert bytes(sent) == b'\x10\x00\x02\x10\x89'
-conn._recv(can.Message(arbitration_id=0x300, data=[0x10,0x00,0x02,0x50,0x89])) #"respond" to interrogation
+conn._recv(bytearray([0x10,0x00,0x02,0x50,0x89])) #"respond" to interrogation
 assert bytes(sent) == b'\xB1' #check that an ACK was sent.
 assert conn.read() == b'\x50\x89' #positive response, same value.
 conn.send(b'\x21\x01') #readDataByLocalIdentifier ID 1.
 assert bytes(sent) == b'\x11\x00\x02\x21\x01'
+conn.close()
+stack.close()
+vwtp.VWTPConnection._send = real #the rest run against a fake gateway on a virtual bus.
+
+#scheduler: a gateway with two channels for four modules; refusals bring the limit down, and every module still gets served.
+ecu = FakeECU(mods=(1, 2, 3, 5), channels=2)
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  sched = vwtp.VWTPScheduler(stack, limit=4)
+  def ident(dest, conn):
+    conn.send(b'\x1a\x9b')
+    return conn.read(timeout=1)
+  res = sched.run([1, 2, 3, 5], ident)
+  assert res == {d: b'\x5a\x9b' for d in (1, 2, 3, 5)}, res
+  assert ecu.peak == 2
+  assert sched.inuse == 0 and sched.free == sched.limit
+  sched = vwtp.VWTPScheduler(stack, limit=4) #refusals from two modules with channels granted: the gateway's full.
+  held = [sched.open(1), sched.open(2)]
+  for dest in (3, 5):
+    try:
+      sched.open(dest)
+      assert False, "gateway should be full"
+    except vwtp.ERefused:
+      pass
+  assert sched.limit == 2 and sched.free == 0
+  vwtp.PROBE = 0 #and each channel given back wins one back, in case they were only busy.
+  for conn in held:
+    sched.release(conn)
+  assert sched.limit == 4
+  res = sched.run([1, 0x11], ident) #nobody answers for 0x11; that's its result, not the whole run's.
+  assert res[1] == b'\x5a\x9b' and isinstance(res[0x11], vwtp.VWTPException)
+bus.shutdown()
+ecu.stop()
+
+#tuning: starts from the granted block size, halves it on a missed ACK, creeps back up on clean ones.
+ecu = FakeECU()
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  conn = stack.connect(1)
+  msg = b'\x2e' + bytes(range(200)) #29 frames with the length field: two blocks at the granted size.
+  assert conn.blocks == conn.blksize == 16
+  conn.send(msg)
+  assert conn.read(timeout=1) == b'\x6e' + msg[1:]
+  assert conn.ackwait < conn.acktime #tuned down from the ECU's timeout to what we've measured.
+  ecu.drop = 1
+  conn.send(msg)
+  assert conn.read(timeout=1) == b'\x6e' + msg[1:] #the block went again, whole.
+  assert conn.stats.retransmits == 1 and conn.blocks == 8
+  for i in range(3):
+    conn.send(msg)
+    assert conn.read(timeout=1) == b'\x6e' + msg[1:]
+  assert 8 < conn.blocks < 16
+  conn.close()
+bus.shutdown()
+ecu.stop()
+
+#timer wheel: one thread fires every timer on time; a touched timer waits out a full interval again, a cancelled one stops.
+wheel = vwtp.TimerWheel(tick=.01)
+fired = []
+t = wheel.add(.05, lambda: fired.append(1))
+time.sleep(.33)
+assert 4 <= len(fired) <= 7, len(fired)
+t.cancel()
+n = len(fired)
+time.sleep(.1)
+assert len(fired) == n
+touched = []
+t = wheel.add(.05, lambda: touched.append(1))
+for i in range(15):
+  t.touch()
+  time.sleep(.02)
+assert not touched
+wheel.stop()
+assert not wheel.thread.is_alive()
+
+#keepalives: an idle channel is pinged, one carrying traffic isn't, and closing the stack stops the wheel.
+ecu = FakeECU()
+ecu.start()
+bus = ecu.tester()
+with vwtp.VWTPStack(bus) as stack:
+  conn = stack.connect(1)
+  for i in range(12):
+    conn.send(b'\x3e')
+    assert conn.read(timeout=1) == b'\x7e'
+    time.sleep(.1)
+  assert ecu.pings == 0
+  time.sleep(1.2)
+  assert ecu.pings >= 1
+  conn.close()
+assert not stack.timers.thread.is_alive()
+bus.shutdown()
+ecu.stop()
+
+#latency histogram: bucket n holds values under 2**n microseconds, and percentiles report the bucket's upper bound.
+h = vwtp.Histogram()
+assert h.percentile(99) == 0.0
+for i in range(99):
+  h.add(.0001) #100us, in the 128us bucket
+h.add(.01) #10ms, in the 16384us bucket
+assert h.percentile(50) == .000128
+assert h.percentile(99) == .000128
+assert h.percentile(100) == .016384
+assert h.count == 100
+print("OK")